@@ -0,0 +1,133 @@
+import torch
+import torch.nn as nn
+import argparse
+import logging
+import os
+from tqdm import tqdm
+
+import util.checkpoint as Checkpoint
+import util.datamaker as Datamaker
+import util.instrument as Instrument
+import util.loss as Loss
+from util.networks import PosNet, NormalNet
+from util.snapshot import SnapshotWriter, FORMATS
+from util.train import predict, compute_loss
+
+logger = logging.getLogger("apply")
+
+# loss weights and learning rates default to those the checkpoint was trained with
+TRAINED_ARGS = ["pos_lr", "norm_lr", "k1", "k2", "k3", "k4", "k5", "grad_crip", "bnfloop", "bnf_neig", "bnf_ring"]
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Denoise a mesh with networks trained on a similar one")
+    parser.add_argument("-i", "--input", type=str, required=True)
+    parser.add_argument("--weights", type=str, required=True, help="checkpoint written by main.py or main4real.py")
+    parser.add_argument("--save_weights", type=str, default=None, help="write the fine-tuned networks to this checkpoint")
+    parser.add_argument("--iter", type=int, default=50)
+    parser.add_argument("--pos_lr", type=float, default=0.01)
+    parser.add_argument("--norm_lr", type=float, default=0.01)
+    parser.add_argument("--k1", type=float, default=3.0)
+    parser.add_argument("--k2", type=float, default=4.0)
+    parser.add_argument("--k3", type=float, default=4.0)
+    parser.add_argument("--k4", type=float, default=4.0)
+    parser.add_argument("--k5", type=float, default=1.0)
+    parser.add_argument("--grad_crip", type=float, default=0.8)
+    parser.add_argument("--bnfloop", type=int, default=1)
+    parser.add_argument("--bnf_neig", type=str, default="edge", choices=["edge", "vertex"])
+    parser.add_argument("--bnf_ring", type=int, default=1)
+    parser.add_argument("--gpu", type=int, default=0)
+    parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "bf16"])
+    parser.add_argument("--checkpoint_segments", type=int, default=0)
+    parser.add_argument("--obj_cache", action="store_true")
+    parser.add_argument("--vs_update", action="store_true")
+    parser.add_argument("--snapshot_freq", type=int, default=0)
+    parser.add_argument("--snapshot_formats", type=str, nargs="+", default=["obj"], choices=FORMATS)
+    parser.add_argument("--snapshot_queue", type=int, default=2)
+    parser.add_argument("--keep_best", action="store_true")
+    parser.add_argument("--log_level", type=str, default="INFO", choices=Instrument.LOG_LEVELS)
+    return parser
+
+def get_parser():
+    parser = build_parser()
+    args = parser.parse_args()
+    Instrument.setup_logging(args.log_level)
+
+    # parse again so that options given on the command line still override the trained ones
+    trained = Checkpoint.load_args(args.weights)
+    if trained:
+        parser.set_defaults(**{k: trained[k] for k in TRAINED_ARGS if k in trained})
+        args = parser.parse_args()
+    else:
+        logger.warning("{} stores no training arguments, using the main.py loss weights".format(args.weights))
+    for k, v in vars(args).items():
+        logger.info("{:12s}: {}".format(k, v))
+
+    return args
+
+
+def main():
+    args = get_parser()
+    device = torch.device("cuda:" + str(args.gpu) if torch.cuda.is_available() else "cpu")
+
+    """ --- create dataset --- """
+    mesh_dic, dataset = Datamaker.create_dataset(args.input, use_cache=args.obj_cache)
+    mesh_name = mesh_dic["mesh_name"]
+    gt_mesh, n_mesh, o1_mesh = mesh_dic["gt_mesh"], mesh_dic["n_mesh"], mesh_dic["o1_mesh"]
+
+    """ --- load the trained networks --- """
+    posnet = PosNet(device, checkpoint_segments=args.checkpoint_segments).to(device)
+    normnet = NormalNet(device, checkpoint_segments=args.checkpoint_segments).to(device)
+    models = {"posnet": posnet, "normnet": normnet}
+    base_epoch = Checkpoint.load_weights(args.weights, models, device)
+    logger.info("loaded networks trained for {} epochs from {}".format(base_epoch, args.weights))
+    optimizer_pos = torch.optim.Adam(posnet.parameters(), lr=args.pos_lr)
+    optimizer_norm = torch.optim.Adam(normnet.parameters(), lr=args.norm_lr)
+    optimizers = {"optimizer_pos": optimizer_pos, "optimizer_norm": optimizer_norm}
+
+    out_dir = "datasets/" + mesh_name + "/output"
+    os.makedirs(out_dir, exist_ok=True)
+    snapshots = SnapshotWriter(o1_mesh, out_dir, gt_mesh=gt_mesh, formats=args.snapshot_formats, keep_best=args.keep_best,
+                               vs_update=args.vs_update, max_queue=args.snapshot_queue, tag="apply")
+
+    """ --- upload loss targets and connectivity once --- """
+    n_vs = torch.from_numpy(n_mesh.vs).to(device)
+    n_fn = torch.from_numpy(n_mesh.fn).to(device)
+    n_mesh_t = n_mesh.tensors(device)
+
+    if gt_mesh is not None:
+        logger.info("initial_mad: {:.3f}".format(Loss.mad(n_mesh.fn, gt_mesh.fn)))
+
+    """ --- fine-tuning; epochs continue from the checkpoint so the losses are weighted as at its end --- """
+    posnet.train()
+    normnet.train()
+    with tqdm(total=args.iter) as pbar:
+        for it in range(1, args.iter+1):
+            optimizer_pos.zero_grad()
+            optimizer_norm.zero_grad()
+            loss, pos, norm = compute_loss(args, base_epoch + it, posnet, normnet, dataset, n_mesh_t, n_vs, n_fn, device)
+            loss.backward()
+            nn.utils.clip_grad_norm_(normnet.parameters(), args.grad_crip)
+            optimizer_pos.step()
+            optimizer_norm.step()
+
+            pbar.set_description("Iteration {}".format(it))
+            pbar.set_postfix({"loss": loss.item()})
+            if args.snapshot_freq > 0 and it % args.snapshot_freq == 0 and it < args.iter:
+                snapshots.submit(it, pos, norm)
+            pbar.update(1)
+
+    """ --- denoised mesh from the final networks --- """
+    with torch.no_grad():
+        pos, norm = predict(args, posnet, normnet, dataset, device)
+    snapshots.submit(args.iter, pos, norm)
+    snapshots.close()
+
+    if args.save_weights is not None:
+        Checkpoint.save(Checkpoint.training_state(base_epoch + args.iter, models, optimizers, args=args), args.save_weights)
+    if snapshots.mad is not None:
+        logger.info("final_mad: {:.3f}".format(snapshots.mad))
+    return snapshots.mad
+
+
+if __name__ == "__main__":
+    main()
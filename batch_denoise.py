@@ -0,0 +1,141 @@
+import argparse
+import contextlib
+import csv
+import glob
+import importlib
+import json
+import multiprocessing as mp
+import os
+import sys
+import time
+import traceback
+
+STAMP = "batch_denoise.json"
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Denoise a set of datasets with a pool of workers")
+    parser.add_argument("inputs", type=str, nargs="*", help="dataset directories or glob patterns")
+    parser.add_argument("--manifest", type=str, default=None, help="text file with one dataset directory per line")
+    parser.add_argument("--script", type=str, default="main", choices=["main", "main4real"])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=1, help="torch threads per worker")
+    parser.add_argument("--summary", type=str, default="batch_summary.csv")
+    parser.add_argument("--force", action="store_true", help="rerun jobs whose outputs are up to date")
+    args, script_args = parser.parse_known_args()
+    args.script_args = script_args
+    return args
+
+def collect_inputs(patterns: list, manifest=None) -> list:
+    """ expand glob patterns and manifest entries into a sorted list of dataset directories """
+    if manifest is not None:
+        with open(manifest) as f:
+            patterns = patterns + [l.strip() for l in f if l.strip() and not l.strip().startswith("#")]
+    dirs = set()
+    for p in patterns:
+        dirs.update(d for d in glob.glob(p) if os.path.isdir(d))
+    return sorted(os.path.normpath(d) for d in dirs)
+
+def output_dir(input_dir: str) -> str:
+    """ directory main.py / main4real.py write their snapshots to """
+    return os.path.join("datasets", os.path.basename(os.path.normpath(input_dir)), "output")
+
+def up_to_date(input_dir: str, key: dict):
+    """ stored result of a previous run with the same arguments that is newer than every input mesh, else None """
+    stamp = os.path.join(output_dir(input_dir), STAMP)
+    if not os.path.exists(stamp):
+        return None
+    with open(stamp) as f:
+        result = json.load(f)
+    if result.get("status") != "ok" or result.get("key") != key:
+        return None
+    inputs = glob.glob(os.path.join(input_dir, "*.obj"))
+    if any(os.path.getmtime(p) > os.path.getmtime(stamp) for p in inputs):
+        return None
+    return result
+
+def init_worker(script: str, threads: int):
+    """ limit threads and import the training script once per worker """
+    # torch reads these when it is first imported, so this module must not import it at the top level
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[var] = str(threads)
+    import torch
+    torch.set_num_threads(threads)
+    global _script
+    _script = importlib.import_module(script)
+
+def run_job(job: tuple) -> dict:
+    """ denoise one dataset, logging its output to the output directory """
+    from util.instrument import reset_peak_rss, peak_rss_mb, setup_logging
+    input_dir, script_args, key = job
+    out_dir = output_dir(input_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    result = {"input": input_dir, "key": key, "status": "ok", "final_mad": None}
+
+    reset_peak_rss()
+    start = time.time()
+    argv = sys.argv
+    try:
+        with open(os.path.join(out_dir, "batch_denoise.log"), "w") as log:
+            with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+                try:
+                    sys.argv = [_script.__name__ + ".py", "-i", input_dir] + script_args
+                    result["final_mad"] = _script.main()
+                except (Exception, SystemExit) as e:
+                    traceback.print_exc()
+                    result["status"] = "failed: {}".format(repr(e))
+                finally:
+                    sys.argv = argv
+    finally:
+        # the script pointed the log handler at the job's log file, which is closed now
+        setup_logging()
+    result["runtime"] = time.time() - start
+    # workers are reused, so this includes memory kept from the worker's earlier jobs
+    result["worker_peak_rss_mb"] = peak_rss_mb()
+
+    with open(os.path.join(out_dir, STAMP), "w") as f:
+        json.dump(result, f)
+    return result
+
+def write_summary(path: str, results: list):
+    """ write results as csv and print them as a table """
+    fields = ["input", "status", "final_mad", "runtime", "worker_peak_rss_mb", "skipped"]
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(results)
+
+    print("{:40s} {:>10s} {:>10s} {:>18s}  {}".format("input", "mad", "time [s]", "worker peak [MB]", "status"))
+    for r in results:
+        mad = "-" if r["final_mad"] is None else "{:.3f}".format(r["final_mad"])
+        status = r["status"] + (" (skipped)" if r["skipped"] else "")
+        print("{:40s} {:>10s} {:>10.1f} {:>18.1f}  {}".format(r["input"], mad, r["runtime"], r.get("worker_peak_rss_mb", float("nan")), status))
+
+def main():
+    args = get_parser()
+    inputs = collect_inputs(args.inputs, args.manifest)
+    if len(inputs) == 0:
+        print("[ERROR] No dataset directories found !")
+        return
+
+    key = {"script": args.script, "args": args.script_args}
+    results, jobs = {}, []
+    for d in inputs:
+        done = None if args.force else up_to_date(d, key)
+        if done is not None:
+            results[d] = dict(done, skipped=True)
+        else:
+            jobs.append((d, args.script_args, key))
+
+    # spawned workers import torch themselves, with their own thread limits
+    if len(jobs) > 0:
+        ctx = mp.get_context("spawn")
+        with ctx.Pool(min(args.workers, len(jobs)), initializer=init_worker, initargs=(args.script, args.threads)) as pool:
+            for r in pool.imap_unordered(run_job, jobs):
+                results[r["input"]] = dict(r, skipped=False)
+                print("[{}/{}] {}: {}".format(len(results), len(inputs), r["input"], r["status"]))
+
+    write_summary(args.summary, [results[d] for d in inputs])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import torch
+
+sys.path.append(".")
+import util.datamaker as Datamaker
+import util.loss as Loss
+import util.models as Models
+from util.instrument import reset_peak_rss, peak_rss_mb
+from util.mesh import Mesh
+from util.meshio import read_obj, write_obj, read_ply, write_ply
+from util.networks import PosNet, NormalNet, autocast
+from util.snapshot import SnapshotWriter
+from util.topology import Topology
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Dual Deep Mesh Prior benchmarks")
+    parser.add_argument("-o", "--output", type=str, default="benchmark.json")
+    parser.add_argument("--kinds", type=str, nargs="+", default=["ico", "grid"], choices=["ico", "grid"])
+    parser.add_argument("--faces", type=int, nargs="+", default=[1000, 10000, 100000], help="approximate face counts of the synthetic meshes")
+    parser.add_argument("--net_max_faces", type=int, default=100000, help="skip the network benchmarks on larger meshes")
+    parser.add_argument("--precisions", type=str, nargs="+", default=["fp32"], choices=["fp32", "bf16"], help="precisions of the network benchmarks")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--compare", type=str, default=None, help="earlier benchmark json to compare against")
+    args = parser.parse_args()
+
+    for k, v in vars(args).items():
+        print("{:12s}: {}".format(k, v))
+
+    return args
+
+def icosphere(level: int):
+    """ unit icosphere with 20 * 4^level faces """
+    t = (1.0 + 5.0 ** 0.5) / 2.0
+    vs = np.array([[-1, t, 0], [1, t, 0], [-1, -t, 0], [1, -t, 0], [0, -1, t], [0, 1, t],
+                   [0, -1, -t], [0, 1, -t], [t, 0, -1], [t, 0, 1], [-t, 0, -1], [-t, 0, 1]], dtype=np.float64)
+    faces = np.array([[0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11], [1, 5, 9], [5, 11, 4],
+                      [11, 10, 2], [10, 7, 6], [7, 1, 8], [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8],
+                      [3, 8, 9], [4, 9, 5], [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]], dtype=np.int64)
+    for _ in range(level):
+        he = np.sort(np.stack([faces, np.roll(faces, -1, axis=1)], axis=2).reshape(-1, 2), axis=1)
+        edges, inv = np.unique(he, axis=0, return_inverse=True)
+        mids = len(vs) + inv.reshape(-1, 3)
+        vs = np.concatenate([vs, 0.5 * (vs[edges[:, 0]] + vs[edges[:, 1]])])
+        a, b, c = faces.T
+        ab, bc, ca = mids.T
+        faces = np.concatenate([np.stack([a, ab, ca], 1), np.stack([b, bc, ab], 1), np.stack([c, ca, bc], 1), np.stack([ab, bc, ca], 1)])
+    vs /= np.linalg.norm(vs, axis=1, keepdims=True)
+    return vs, faces
+
+def grid(n: int):
+    """ wavy n x n vertex height field with 2 * (n-1)^2 faces """
+    x, y = np.meshgrid(np.linspace(0, 1, n), np.linspace(0, 1, n))
+    z = 0.05 * np.sin(6 * np.pi * x) * np.cos(4 * np.pi * y)
+    vs = np.stack([x.ravel(), y.ravel(), z.ravel()], axis=1)
+    ids = np.arange(n * n).reshape(n, n)
+    a, b, c, d = ids[:-1, :-1].ravel(), ids[:-1, 1:].ravel(), ids[1:, :-1].ravel(), ids[1:, 1:].ravel()
+    faces = np.concatenate([np.stack([a, b, d], 1), np.stack([a, d, c], 1)])
+    return vs, faces
+
+def synthetic(kind: str, n_faces: int):
+    """ synthetic mesh of the given kind with about n_faces faces """
+    if kind == "ico":
+        level = max(0, int(np.round(np.log(n_faces / 20.0) / np.log(4.0))))
+        return "ico{}".format(level), icosphere(level)
+    n = max(2, int(np.round((n_faces / 2.0) ** 0.5)) + 1)
+    return "grid{}".format(n), grid(n)
+
+def make_dataset(root: str, name: str, vs: np.ndarray, faces: np.ndarray) -> str:
+    """ write a noisy / smooth / ground-truth triple in the layout create_dataset expects """
+    path = os.path.join(root, name)
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.RandomState(314)
+    scale = np.linalg.norm(vs[faces[:, 0]] - vs[faces[:, 1]], axis=1).mean()
+    write_obj(os.path.join(path, name + "_gt.obj"), vs, faces)
+    write_obj(os.path.join(path, name + "_smooth.obj"), vs, faces)
+    write_obj(os.path.join(path, name + "_noise.obj"), vs + 0.2 * scale * rng.normal(size=vs.shape), faces)
+    return path
+
+def measure(fn, repeat: int) -> dict:
+    """ median wall-clock time of fn() and the peak rss reached while running it """
+    fn()
+    reset_peak_rss()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {"seconds": float(np.median(times)), "min_seconds": float(np.min(times)), "peak_rss_mb": peak_rss_mb()}
+
+def grad_step(loss_fn, *inputs):
+    """ forward and backward of a loss with respect to fresh leaf copies of its tensor inputs """
+    def run():
+        leaves = [x.detach().clone().requires_grad_() for x in inputs]
+        loss_fn(*leaves).backward()
+    return run
+
+def bench_mesh(name: str, path: str, repeat: int) -> list:
+    """ cases covering mesh construction and training of one dataset """
+    n_file = os.path.join(path, name + "_noise.obj")
+    vs, faces = read_obj(n_file)
+    cases = [
+        ("read_obj", lambda: read_obj(n_file)),
+        ("topology", lambda: Topology(faces, len(vs))),
+        ("mesh_init", lambda: Mesh(n_file)),
+        ("create_dataset", lambda: Datamaker.create_dataset(path)),
+    ]
+    results = [dict(case=c, **measure(fn, repeat)) for c, fn in cases]
+
+    mesh_dic, dataset = Datamaker.create_dataset(path)
+    n_mesh, gt_mesh = mesh_dic["n_mesh"], mesh_dic["gt_mesh"]
+    mesh_t = n_mesh.tensors("cpu")
+    n_vs, n_fn = torch.from_numpy(n_mesh.vs).float(), torch.from_numpy(n_mesh.fn).float()
+    pos = n_vs + 0.01 * torch.randn(n_vs.shape)
+    norm = torch.nn.functional.normalize(n_fn + 0.1 * torch.randn(n_fn.shape), dim=1)
+    cases = [
+        ("pos_rec_loss", grad_step(lambda p: Loss.pos_rec_loss(p, n_vs), pos)),
+        ("mesh_laplacian_loss", grad_step(lambda p: Loss.mesh_laplacian_loss(p, mesh_t), pos)),
+        ("norm_rec_loss", grad_step(lambda n: Loss.norm_rec_loss(n, n_fn), norm)),
+        ("fn_bnf_loss", grad_step(lambda p, n: Loss.fn_bnf_loss(p, n, mesh_t, loop=5)[0], pos, norm)),
+        ("pos_norm_loss", grad_step(lambda p, n: Loss.pos_norm_loss(p, n, mesh_t), pos, norm)),
+        ("face_geometry", grad_step(lambda p: Models.FaceGeometry(p, mesh_t.faces).fn.sum(), pos)),
+    ]
+    results += [dict(case=c, **measure(fn, repeat)) for c, fn in cases]
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        snapshots = SnapshotWriter(n_mesh, out_dir, gt_mesh=gt_mesh)
+        results.append(dict(case="snapshot", **measure(lambda: snapshots.write(0, pos), repeat)))
+        snapshots.close()
+        ply = os.path.join(out_dir, "bench.ply")
+        results.append(dict(case="write_ply", **measure(lambda: write_ply(ply, n_mesh.vs, n_mesh.faces, face_attrs={"color": n_mesh.fn, "quality": n_mesh.fa}), repeat)))
+        results.append(dict(case="read_ply", **measure(lambda: read_ply(ply), repeat)))
+    return results
+
+def bench_networks(path: str, repeat: int, precisions=("fp32",)) -> list:
+    """ forward and backward passes of both networks on one dataset, in each precision """
+    _, dataset = Datamaker.create_dataset(path)
+    device = torch.device("cpu")
+    torch.manual_seed(314)
+    posnet, normnet = PosNet(device), NormalNet(device)
+
+    def step(net, precision):
+        def run():
+            net.zero_grad()
+            with autocast(precision, device):
+                out = net(dataset)
+            out.float().sum().backward()
+        return run
+    results = []
+    for precision in precisions:
+        suffix = "" if precision == "fp32" else "_" + precision
+        results.append(dict(case="posnet_step" + suffix, **measure(step(posnet, precision), repeat)))
+        results.append(dict(case="normnet_step" + suffix, **measure(step(normnet, precision), repeat)))
+    return results
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results: list, old_path: str, threshold=1.2):
+    """ print the speed ratio of every case also found in an earlier benchmark, using the fastest repeats """
+    with open(old_path) as f:
+        old = {(r["mesh"], r["case"]): r for r in json.load(f)["results"]}
+    print("{:12s} {:20s} {:>10s} {:>10s} {:>8s}".format("mesh", "case", "old [s]", "new [s]", "ratio"))
+    for r in results:
+        o = old.get((r["mesh"], r["case"]))
+        if o is None:
+            continue
+        ratio = r["min_seconds"] / max(o["min_seconds"], 1.0e-12)
+        flag = "  <- slower" if ratio > threshold else ""
+        print("{:12s} {:20s} {:10.4f} {:10.4f} {:8.2f}{}".format(r["mesh"], r["case"], o["min_seconds"], r["min_seconds"], ratio, flag))
+
+def main():
+    args = get_parser()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        for kind in args.kinds:
+            for n_faces in args.faces:
+                name, (vs, faces) = synthetic(kind, n_faces)
+                path = make_dataset(root, name, vs, faces)
+                mesh_results = bench_mesh(name, path, args.repeat)
+                if len(faces) <= args.net_max_faces:
+                    mesh_results += bench_networks(path, args.repeat, args.precisions)
+                for r in mesh_results:
+                    r.update(mesh=name, vertices=len(vs), faces=len(faces), faces_per_s=len(faces) / max(r["seconds"], 1.0e-12))
+                    print("{:12s} {:20s} {:10.4f} s {:12.0f} faces/s {:10.1f} MB".format(name, r["case"], r["seconds"], r["faces_per_s"], r["peak_rss_mb"]))
+                results += mesh_results
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "threads": torch.get_num_threads(),
+            "machine": platform.machine(),
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,10 +7,11 @@ from matplotlib import cm
 
 sys.path.append(".")
 from util.mesh import Mesh
+from util.meshio import write_ply
 import util.loss as Loss
 
 def mad2color(mad, max_th=50):
-    color = np.zeros([len(mad), 3]).astype(np.float)
+    color = np.zeros([len(mad), 3]).astype(float)
     mad = np.clip(mad, 0.0, max_th)
     mad /= max_th
     c = cm.jet(mad)
@@ -40,12 +41,14 @@ def main():
     mad_list = {}
     for a in all_path:
         if g_path[0] != a:
-            a_mesh = Mesh(a)
+            a_mesh = Mesh(a, topology=g_mesh.topology)
             mad = Loss.mad(a_mesh.fn, g_mesh.fn)
             sad = Loss.angular_difference(a_mesh.fn, g_mesh.fn)
             mad_list[os.path.basename(a)] = mad
             color = mad2color(sad)
-            a_mesh.save_as_ply(FLAGS.input + "/mad/" + os.path.basename(a).split(".")[0] + "={:.3f}.ply".format(mad), color)
+            # the per-face angular error is kept as face quality next to its colors
+            write_ply(FLAGS.input + "/mad/" + os.path.basename(a).split(".")[0] + "={:.3f}.ply".format(mad), a_mesh.vs, a_mesh.faces,
+                      face_attrs={"color": color, "quality": sad})
     
     for k, v in mad_list.items():
         print("{:20s}: {:.3f}".format(k, v))
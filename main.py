@@ -1,18 +1,26 @@
 import torch
 import torch.nn as nn
-from torch.autograd import profiler
 import argparse
+import logging
 import os
 from tqdm import tqdm
 
 import util.loss as Loss
 import util.models as Models
 import util.datamaker as Datamaker
+import util.distributed as Dist
+import util.checkpoint as Checkpoint
+import util.instrument as Instrument
 from util.mesh import Mesh
+from util.convergence import ConvergenceMonitor
 from util.networks import PosNet, NormalNet
-import cProfile
+from util.partition import Partition, shared_labels
+from util.snapshot import SnapshotWriter, FORMATS
+from util.train import snapshot_predict, compute_loss
 
-def get_parser():
+logger = logging.getLogger("main")
+
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Dual Deep Mesh Prior")
     parser.add_argument("-i", "--input", type=str, required=True)
     parser.add_argument("--pos_lr", type=float, default=0.01)
@@ -26,102 +34,190 @@ def get_parser():
     parser.add_argument("--k5", type=float, default=1.0)
     parser.add_argument("--grad_crip", type=float, default=0.8)
     parser.add_argument("--bnfloop", type=int, default=1)
+    parser.add_argument("--bnf_neig", type=str, default="edge", choices=["edge", "vertex"])
+    parser.add_argument("--bnf_ring", type=int, default=1)
     parser.add_argument("--gpu", type=int, default=0)
-    args = parser.parse_args()
+    parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "bf16"])
+    parser.add_argument("--checkpoint_segments", type=int, default=0)
+    parser.add_argument("--obj_cache", action="store_true")
+    parser.add_argument("--patches", type=int, default=0)
+    parser.add_argument("--patch_halo", type=int, default=4)
+    parser.add_argument("--patch_batch", type=int, default=1)
+    parser.add_argument("--dist_backend", type=str, default="gloo")
+    parser.add_argument("--ckpt_freq", type=int, default=100)
+    parser.add_argument("--ckpt", type=str, default=None)
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--vs_update", action="store_true")
+    parser.add_argument("--snapshot_freq", type=int, default=10)
+    parser.add_argument("--snapshot_formats", type=str, nargs="+", default=["obj"], choices=FORMATS)
+    parser.add_argument("--snapshot_queue", type=int, default=2)
+    parser.add_argument("--keep_best", action="store_true")
+    parser.add_argument("--early_stop", action="store_true", help="stop once the loss plateaus or the normals stop changing")
+    parser.add_argument("--stop_patience", type=int, default=100, help="epochs without relative loss improvement before stopping")
+    parser.add_argument("--stop_rel_tol", type=float, default=1.0e-3)
+    parser.add_argument("--stop_normal_tol", type=float, default=0.01, help="mean face normal change between snapshots [deg per epoch]")
+    parser.add_argument("--stop_min_epochs", type=int, default=150)
+    parser.add_argument("--profile", type=str, default="off", choices=Instrument.PROFILERS)
+    parser.add_argument("--timings", type=str, default=None, help="append per-stage timings as json lines to this file")
+    parser.add_argument("--log_level", type=str, default="INFO", choices=Instrument.LOG_LEVELS)
+    return parser
+
+
+def get_parser():
+    args = build_parser().parse_args()
 
+    Instrument.setup_logging(args.log_level)
     for k, v in vars(args).items():
-        print("{:12s}: {}".format(k, v))
+        logger.info("{:12s}: {}".format(k, v))
     
     return args
 
 
 def main():
-    print("parser")
     args = get_parser()
+    rank, world_size = Dist.init(args.dist_backend)
+    gpu = Dist.local_rank() if world_size > 1 else args.gpu
+    device = torch.device("cuda:" + str(gpu) if torch.cuda.is_available() else "cpu")
+    if args.timings is not None and Dist.is_main():
+        Instrument.TIMERS.enable(args.timings, device)
     
-    """ --- create dataset --- """
-    print("creating dataset")
-    mesh_dic, dataset = Datamaker.create_dataset(args.input)
-    for batch_ndx, sample in enumerate(Datamaker.loader(dataset)):
-        mesh_name = mesh_dic["mesh_name"]
-        gt_mesh, n_mesh, o1_mesh = mesh_dic["gt_mesh"], mesh_dic["n_mesh"], mesh_dic["o1_mesh"]
+    """ --- create dataset; only rank 0 builds the full mesh, the other ranks read what their patches need --- """
+    n_parts = args.patches if args.patches > 0 or world_size == 1 else world_size
+    assert n_parts == 0 or n_parts >= world_size, "every rank needs at least one patch"
+    with Instrument.stage("dataset"):
+        if Dist.is_main():
+            mesh_dic, dataset = Datamaker.create_dataset(args.input, use_cache=args.obj_cache)
+            gt_mesh, n_mesh, o1_mesh = mesh_dic["gt_mesh"], mesh_dic["n_mesh"], mesh_dic["o1_mesh"]
+            inputs = Datamaker.MeshInputs.from_meshes(mesh_dic)
+        else:
+            n_mesh = None
+            inputs = Datamaker.MeshInputs.from_files(args.input, use_cache=args.obj_cache)
+    mesh_name = inputs.mesh_name
 
     """ --- create model instance --- """
-    print("creating model instance")
-    device = torch.device("cuda:" + str(args.gpu) if torch.cuda.is_available() else "cpu")
-    posnet = PosNet(device).to(device)
-    normnet = NormalNet(device).to(device)
+    posnet = PosNet(device, checkpoint_segments=args.checkpoint_segments).to(device)
+    normnet = NormalNet(device, checkpoint_segments=args.checkpoint_segments).to(device)
+    Dist.broadcast_parameters(posnet)
+    Dist.broadcast_parameters(normnet)
     optimizer_pos = torch.optim.Adam(posnet.parameters(), lr=args.pos_lr)
     optimizer_norm = torch.optim.Adam(normnet.parameters(), lr=args.norm_lr)
-    print("making dirs")
     os.makedirs("datasets/" + mesh_name + "/output", exist_ok=True)
 
+    """ --- resume from the last checkpoint --- """
+    ckpt_path = args.ckpt or "datasets/" + mesh_name + "/output/checkpoint.pt"
+    models = {"posnet": posnet, "normnet": normnet}
+    optimizers = {"optimizer_pos": optimizer_pos, "optimizer_norm": optimizer_norm}
+    start_epoch = 1
+    if args.resume:
+        if os.path.exists(ckpt_path):
+            start_epoch = Checkpoint.load(ckpt_path, models, optimizers, device) + 1
+            logger.info("resuming from epoch {}".format(start_epoch))
+        else:
+            logger.warning("No checkpoint at {}, starting from scratch".format(ckpt_path))
+    ckpt_writer = Checkpoint.CheckpointWriter() if Dist.is_main() and args.ckpt_freq > 0 else None
+
+    """ --- snapshots are evaluated and written in the background --- """
+    snapshots = None
+    if Dist.is_main() and args.snapshot_freq > 0:
+        snapshots = SnapshotWriter(o1_mesh, "datasets/" + mesh_name + "/output", gt_mesh=gt_mesh, formats=args.snapshot_formats,
+                                   keep_best=args.keep_best, vs_update=args.vs_update, max_queue=args.snapshot_queue)
+
+    """ --- upload loss targets and connectivity once, or split large meshes into overlapping patches dealt round-robin to the ranks --- """
+    partition = None
+    if n_parts == 0:
+        n_vs = torch.from_numpy(n_mesh.vs).to(device)
+        n_fn = torch.from_numpy(n_mesh.fn).to(device)
+        n_mesh_t = n_mesh.tensors(device)
+        faces = n_mesh_t.faces
+    else:
+        local_parts = list(range(rank, n_parts, world_size))
+        labels = shared_labels(n_mesh, n_parts, len(inputs.vs))
+        partition = Partition(inputs, labels, n_parts, halo=args.patch_halo, device=device, parts=local_parts)
+        faces = torch.from_numpy(inputs.faces).long().to(device)
+
+    """ --- early stopping; every rank sees the same loss and stitched positions, so all stop together --- """
+    monitor = None
+    if args.early_stop:
+        monitor = ConvergenceMonitor(patience=args.stop_patience, rel_tol=args.stop_rel_tol,
+                                     normal_tol=args.stop_normal_tol, min_epochs=args.stop_min_epochs)
+
     """ --- initial condition --- """
-    print("initial loss function")
-    init_mad = mad_value = Loss.mad(n_mesh.fn, gt_mesh.fn)
-    print("initial_mad: {:.3f}".format(init_mad))
+    if Dist.is_main():
+        init_mad = mad_value = Loss.mad(n_mesh.fn, gt_mesh.fn)
+        logger.info("initial_mad: {:.3f}".format(init_mad))
+    Instrument.emit(epoch=0)
 
     """ --- learning loop --- """
-    with torch.autograd.profiler.profile() as prof:
-        with tqdm(total=args.iter) as pbar:
-            for epoch in range(1, args.iter+1):
-                print("training")
+    with Instrument.profiler(args.profile, "datasets/" + mesh_name + "/output", device):
+        with tqdm(total=args.iter, initial=start_epoch - 1, disable=not Dist.is_main()) as pbar:
+            for epoch in range(start_epoch, args.iter+1):
                 posnet.train()
                 normnet.train()
                 optimizer_pos.zero_grad()
                 optimizer_norm.zero_grad()
 
-                pos = posnet(dataset)
-                loss_pos1 = Loss.pos_rec_loss(pos, n_mesh.vs)
-                loss_pos2 = Loss.mesh_laplacian_loss(pos, n_mesh)
-
-                norm = normnet(dataset)
-                loss_norm1 = Loss.norm_rec_loss(norm, n_mesh.fn)
-                loss_norm2, _ = Loss.fn_bnf_loss(pos, norm, n_mesh, loop=args.bnfloop)
-                
-                if epoch <= 100:
-                    loss_norm2 = loss_norm2 * 0.0
-
-                loss_pos3 = Loss.pos_norm_loss(pos, norm, n_mesh)
-
-                loss = args.k1 * loss_pos1 + args.k2 * loss_pos2 + args.k3 * loss_norm1 + args.k4 * loss_norm2 + args.k5 * loss_pos3
-                loss.backward()
-                nn.utils.clip_grad_norm_(normnet.parameters(), args.grad_crip)
-                optimizer_pos.step()
-                optimizer_norm.step()
+                if partition is None:
+                    loss, pos, norm = compute_loss(args, epoch, posnet, normnet, dataset, n_mesh_t, n_vs, n_fn, device)
+                    with Instrument.stage("backward"):
+                        loss.backward()
+                    loss = loss.item()
+                else:
+                    batch = [local_parts[i] for i in torch.randperm(len(local_parts))[:args.patch_batch].tolist()]
+                    loss = 0.0
+                    for p in batch:
+                        patch = partition.patches[p]
+                        p_loss, _, _ = compute_loss(args, epoch, posnet, normnet, patch.dataset, patch.mesh_t, patch.n_vs, patch.n_fn, device)
+                        with Instrument.stage("backward"):
+                            (p_loss / len(batch)).backward()
+                        loss += p_loss.item() / len(batch)
+                    with Instrument.stage("all_reduce"):
+                        Dist.average_gradients([posnet, normnet])
+                        loss = Dist.all_reduce_mean(loss)
+                with Instrument.stage("step"):
+                    nn.utils.clip_grad_norm_(normnet.parameters(), args.grad_crip)
+                    optimizer_pos.step()
+                    optimizer_norm.step()
 
                 pbar.set_description("Epoch {}".format(epoch))
-                pbar.set_postfix({"loss": loss.item()})
-                
-                vs_update = False
-
-                if epoch % 10 == 0:
-                    new_pos = pos.to("cpu").detach().numpy().copy()
-                    o1_mesh.vs = new_pos
-                    Mesh.compute_face_normals(o1_mesh)
-                    Mesh.compute_vert_normals(o1_mesh)
-
-                    mad_value = Loss.mad(o1_mesh.fn, gt_mesh.fn)
-                    o_path = "datasets/" + mesh_name + "/output/" + str(epoch) + "_ddmp={:.3f}.obj".format(mad_value)
-                    Mesh.save(o1_mesh, o_path)
-
-                    if vs_update:
-                        updated_pos = Models.vertex_updating(pos, norm, o1_mesh, loop=15)
-                        o1_mesh.vs = updated_pos.to("cpu").detach().numpy().copy()
-                        Mesh.compute_face_normals(o1_mesh)
-                        updated_mad = Loss.mad(o1_mesh.fn, gt_mesh.fn)
-                        u_path = "datasets/" + mesh_name + "/output/" + str(epoch) + "_ddmp_updated={:.3f}.obj".format(updated_mad)
-                        Mesh.save(o1_mesh, u_path)
-
+                pbar.set_postfix({"loss": loss})
+
+                stop = monitor is not None and monitor.update_loss(epoch, loss)
+                if args.snapshot_freq > 0 and (epoch % args.snapshot_freq == 0 or stop):
+                    with Instrument.stage("snapshot"):
+                        if partition is not None:
+                            # batch statistics as in training, so that patches match the full-mesh snapshots
+                            outputs = [snapshot_predict(args, posnet, normnet, partition.patches[p].dataset, device) for p in local_parts]
+                            pos = Dist.all_reduce_sum(partition.stitch_vertices([o[0] for o in outputs], parts=local_parts))
+                            norm = Dist.all_reduce_sum(partition.stitch_faces([o[1] for o in outputs], parts=local_parts))
+                        if monitor is not None and not stop:
+                            with torch.no_grad():
+                                stop = monitor.update_normals(epoch, Models.FaceGeometry(pos.float(), faces).fn)
+                        if snapshots is not None:
+                            snapshots.submit(epoch, pos, norm)
+
+                if ckpt_writer is not None and (epoch % args.ckpt_freq == 0 or epoch == args.iter or stop):
+                    with Instrument.stage("checkpoint"):
+                        ckpt_writer.save(Checkpoint.training_state(epoch, models, optimizers, args=args), ckpt_path)
+
+                Instrument.emit(epoch=epoch, loss=loss)
                 pbar.update(1)
-    print("final_mad: {:.3f}".format(mad_value))
-    print(prof.key_averages().table(sort_by="self_cpu_time_total"))
-    print(prof.key_averages().table(sort_by="cuda_time_total", row_limit=10))
-
-ob = cProfile.Profile()
-ob.enable()
-ob.print_stats()
-ob.disable()
+                if stop:
+                    logger.info("stopping early at epoch {}: {}".format(epoch, monitor.reason))
+                    break
+    if ckpt_writer is not None:
+        ckpt_writer.close()
+    if snapshots is not None:
+        snapshots.close()
+        if snapshots.mad is not None:
+            mad_value = snapshots.mad
+    if monitor is not None and rank == 0:
+        monitor.save("datasets/" + mesh_name + "/output/convergence.json", iter=args.iter)
+    Instrument.TIMERS.close()
+    Dist.shutdown()
+    if rank != 0:
+        return
+    logger.info("final_mad: {:.3f}".format(mad_value))
+    return mad_value
 
 
 if __name__ == "__main__":
@@ -62,7 +62,7 @@ def main():
     g_mesh.compute_face_normals()
     g_mesh.save(g_file)
 
-    n_mesh = Mesh(g_file)
+    n_mesh = Mesh(g_file, topology=g_mesh.topology)
     if args.noise == "gaussian":
         n_mesh = gausian_noise(n_mesh, args.level)
         n_mesh.compute_face_normals()
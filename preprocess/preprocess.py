@@ -60,8 +60,8 @@ def main():
         normalize(ms, n_file, s_file)
 
     n_mesh = Mesh(n_file)
-    s_mesh = Mesh(s_file)
-    g_mesh = Mesh(g_file)
+    s_mesh = Mesh(s_file, topology=n_mesh.topology)
+    g_mesh = Mesh(g_file, topology=n_mesh.topology)
 
     edge_vec = n_mesh.vs[n_mesh.edges][:, 0, :] - n_mesh.vs[n_mesh.edges][:, 1, :]
     ave_len = np.sum(np.linalg.norm(edge_vec, axis=1)) / n_mesh.edges.shape[0]
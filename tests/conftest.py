@@ -0,0 +1,20 @@
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def synthetic_meshes():
+    """ the benchmark's mesh generators, which need the full network stack to import """
+    pytest.importorskip("torch_geometric")
+    pytest.importorskip("torch_scatter")
+    import benchmark.benchmark as Benchmark
+    return Benchmark
+
+@pytest.fixture
+def ico_dataset(tmp_path):
+    """ noisy / smooth / ground-truth icosphere with 1280 faces in the create_dataset layout """
+    Benchmark = synthetic_meshes()
+    vs, faces = Benchmark.icosphere(3)
+    return Benchmark.make_dataset(str(tmp_path), "ico3", vs, faces)
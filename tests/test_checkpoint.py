@@ -0,0 +1,103 @@
+import os
+import sys
+import argparse
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+import util.checkpoint as Checkpoint
+
+def tiny_step(model: nn.Module, optimizer, x: torch.Tensor):
+    """ one step whose loss depends on the torch and numpy rngs, like the training loop """
+    optimizer.zero_grad()
+    noise = torch.from_numpy(np.random.normal(size=x.shape)).float()
+    loss = (model(x + 1e-2 * noise + 1e-2 * torch.randn_like(x)) ** 2).mean()
+    loss.backward()
+    optimizer.step()
+
+def tiny_model():
+    model = nn.Sequential(nn.Linear(4, 8), nn.BatchNorm1d(8), nn.LeakyReLU(), nn.Linear(8, 2))
+    return model, torch.optim.Adam(model.parameters(), lr=0.01)
+
+def assert_same_state(a: dict, b: dict):
+    assert a.keys() == b.keys()
+    for k in a:
+        if torch.is_tensor(a[k]):
+            assert torch.equal(a[k], b[k]), k
+        elif isinstance(a[k], dict):
+            assert_same_state(a[k], b[k])
+        else:
+            assert a[k] == b[k], k
+
+def test_resume_tiny_model(tmp_path):
+    x = torch.randn(16, 4)
+    torch.manual_seed(0)
+    np.random.seed(0)
+    model, optimizer = tiny_model()
+    for _ in range(6):
+        tiny_step(model, optimizer, x)
+    straight = Checkpoint.training_state(6, {"model": model}, {"optimizer": optimizer})
+
+    torch.manual_seed(0)
+    np.random.seed(0)
+    model, optimizer = tiny_model()
+    for _ in range(3):
+        tiny_step(model, optimizer, x)
+    path = str(tmp_path / "checkpoint.pt")
+    args = argparse.Namespace(k1=3.0, iter=6)
+    writer = Checkpoint.CheckpointWriter()
+    writer.save(Checkpoint.training_state(3, {"model": model}, {"optimizer": optimizer}, args=args), path)
+    writer.close()
+    assert os.listdir(str(tmp_path)) == ["checkpoint.pt"]
+
+    # fresh weights and rngs, all replaced by the checkpoint
+    torch.manual_seed(1)
+    np.random.seed(1)
+    model, optimizer = tiny_model()
+    assert Checkpoint.load(path, {"model": model}, {"optimizer": optimizer}, "cpu") == 3
+    for _ in range(3):
+        tiny_step(model, optimizer, x)
+    resumed = Checkpoint.training_state(6, {"model": model}, {"optimizer": optimizer})
+
+    assert_same_state(straight["model"], resumed["model"])
+    assert_same_state(straight["optimizer"], resumed["optimizer"])
+    assert torch.equal(straight["rng"]["torch"], resumed["rng"]["torch"])
+    assert Checkpoint.load_args(path) == {"k1": 3.0, "iter": 6}
+
+def test_load_weights_and_old_checkpoints(tmp_path):
+    model, optimizer = tiny_model()
+    path = str(tmp_path / "checkpoint.pt")
+    Checkpoint.save(Checkpoint.training_state(7, {"model": model}, {"optimizer": optimizer}), path)
+    other, _ = tiny_model()
+    assert Checkpoint.load_weights(path, {"model": other}, "cpu") == 7
+    assert_same_state(model.state_dict(), other.state_dict())
+    assert Checkpoint.load_args(path) == {}
+
+def test_writer_reports_errors(tmp_path):
+    model, optimizer = tiny_model()
+    writer = Checkpoint.CheckpointWriter()
+    writer.save(Checkpoint.training_state(1, {"model": model}, {"optimizer": optimizer}), str(tmp_path / "missing" / "checkpoint.pt"))
+    with pytest.raises((OSError, RuntimeError)):
+        writer.close()
+    assert not os.path.exists(str(tmp_path / "missing"))
+
+def run_main(monkeypatch, path: str, *argv):
+    import main as Main
+    monkeypatch.setattr(sys, "argv", ["main.py", "-i", path, "--snapshot_freq", "0"] + list(argv))
+    Main.main()
+
+def test_resume_main(ico_dataset, tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    straight, resumed = str(tmp_path / "straight.pt"), str(tmp_path / "resumed.pt")
+    torch.manual_seed(0)
+    run_main(monkeypatch, ico_dataset, "--iter", "6", "--ckpt", straight)
+    torch.manual_seed(0)
+    run_main(monkeypatch, ico_dataset, "--iter", "3", "--ckpt", resumed)
+    torch.manual_seed(1)
+    run_main(monkeypatch, ico_dataset, "--iter", "6", "--ckpt", resumed, "--resume")
+
+    a, b = Checkpoint._load(straight, "cpu"), Checkpoint._load(resumed, "cpu")
+    assert a["epoch"] == b["epoch"] == 6
+    for k in ("posnet", "normnet", "optimizer_pos", "optimizer_norm"):
+        assert_same_state(a[k], b[k])
@@ -0,0 +1,104 @@
+import os
+import socket
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip("torch_geometric")
+pytest.importorskip("torch_scatter")
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+import main as Main
+import util.datamaker as Datamaker
+import util.distributed as Dist
+from util.networks import PosNet, NormalNet
+from util.partition import Partition, shared_labels
+from util.train import snapshot_predict, compute_loss
+
+N_PARTS = 2
+
+def train_patches(path: str, rank: int, world_size: int, iters=3) -> dict:
+    """ the patched training loop of main.py with every local patch in each batch, then a stitched snapshot """
+    args = Main.build_parser().parse_args(["-i", path, "--patch_halo", "2"])
+    device = torch.device("cpu")
+    if Dist.is_main():
+        mesh_dic, _ = Datamaker.create_dataset(path)
+        n_mesh, inputs = mesh_dic["n_mesh"], Datamaker.MeshInputs.from_meshes(mesh_dic)
+    else:
+        n_mesh, inputs = None, Datamaker.MeshInputs.from_files(path)
+    local_parts = list(range(rank, N_PARTS, world_size))
+    partition = Partition(inputs, shared_labels(n_mesh, N_PARTS, len(inputs.vs)), N_PARTS, halo=args.patch_halo, device=device, parts=local_parts)
+
+    # different initial weights on every rank, so that only the broadcast makes them agree
+    torch.manual_seed(rank)
+    posnet, normnet = PosNet(device), NormalNet(device)
+    Dist.broadcast_parameters(posnet)
+    Dist.broadcast_parameters(normnet)
+    optimizer_pos = torch.optim.Adam(posnet.parameters(), lr=args.pos_lr)
+    optimizer_norm = torch.optim.Adam(normnet.parameters(), lr=args.norm_lr)
+    for epoch in range(1, iters + 1):
+        optimizer_pos.zero_grad()
+        optimizer_norm.zero_grad()
+        for p in local_parts:
+            patch = partition.patches[p]
+            loss, _, _ = compute_loss(args, epoch, posnet, normnet, patch.dataset, patch.mesh_t, patch.n_vs, patch.n_fn, device)
+            (loss / len(local_parts)).backward()
+        Dist.average_gradients([posnet, normnet])
+        nn.utils.clip_grad_norm_(normnet.parameters(), args.grad_crip)
+        optimizer_pos.step()
+        optimizer_norm.step()
+
+    outputs = [snapshot_predict(args, posnet, normnet, partition.patches[p].dataset, device) for p in local_parts]
+    return {
+        "params": [t.detach().clone() for net in (posnet, normnet) for t in net.parameters()],
+        "pos": Dist.all_reduce_sum(partition.stitch_vertices([o[0] for o in outputs], parts=local_parts)),
+        "norm": Dist.all_reduce_sum(partition.stitch_faces([o[1] for o in outputs], parts=local_parts)),
+    }
+
+def _worker(rank: int, world_size: int, port: int, path: str, out_dir: str):
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port), RANK=str(rank), WORLD_SIZE=str(world_size))
+    torch.set_num_threads(1)
+    Dist.init("gloo")
+    try:
+        torch.save(train_patches(path, rank, world_size), os.path.join(out_dir, "rank{}.pt".format(rank)))
+    finally:
+        Dist.shutdown()
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def test_patch_inputs_match_dataset(ico_dataset):
+    mesh_dic, dataset = Datamaker.create_dataset(ico_dataset)
+    n_mesh = mesh_dic["n_mesh"]
+    inputs = Datamaker.MeshInputs.from_files(ico_dataset)
+    labels = shared_labels(n_mesh, 3, len(inputs.vs))
+    partition = Partition(inputs, labels, 3, halo=2)
+
+    adj = n_mesh.topology.v2v_mat.to_dense().numpy() > 0
+    for part, patch in enumerate(partition.patches):
+        mask = labels == part
+        for _ in range(2):
+            mask = mask | adj[mask].any(axis=0)
+        assert np.array_equal(patch.verts, np.nonzero(mask)[0])
+        assert np.array_equal(patch.faces, np.nonzero(mask[n_mesh.faces].all(axis=1))[0])
+        assert torch.equal(patch.dataset.z1, dataset.z1.detach()[patch.verts])
+        assert torch.equal(patch.dataset.z2, dataset.z2.detach()[patch.faces])
+        assert torch.equal(patch.dataset.x_pos, dataset.x_pos[patch.verts])
+        assert torch.equal(patch.dataset.x_norm, dataset.x_norm[patch.faces])
+        assert np.array_equal(patch.n_fn.numpy(), n_mesh.fn[patch.faces])
+
+def test_two_ranks_match_single_process(ico_dataset, tmp_path):
+    mp.spawn(_worker, args=(2, _free_port(), ico_dataset, str(tmp_path)), nprocs=2, join=True)
+    ranks = [torch.load(os.path.join(str(tmp_path), "rank{}.pt".format(r))) for r in range(2)]
+    single = train_patches(ico_dataset, 0, 1)
+
+    for a, b in zip(ranks[0]["params"], ranks[1]["params"]):
+        assert torch.equal(a, b)
+    for a, b in zip(ranks[0]["params"], single["params"]):
+        assert torch.allclose(a, b, atol=1e-4)
+    for key in ("pos", "norm"):
+        assert torch.equal(ranks[0][key], ranks[1][key])
+        assert torch.allclose(ranks[0][key], single[key], atol=1e-4)
@@ -0,0 +1,151 @@
+import os
+import numpy as np
+import pytest
+
+from util.meshio import read_obj, read_obj_cached, write_obj, cache_path, read_ply, write_ply
+
+def baseline_read_obj(path: str):
+    """ the original line-by-line Mesh.fill_from_file """
+    vs, faces = [], []
+    with open(path) as f:
+        for line in f:
+            splitted_line = line.strip().split()
+            if not splitted_line:
+                continue
+            elif splitted_line[0] == "v":
+                vs.append([float(v) for v in splitted_line[1:4]])
+            elif splitted_line[0] == "f":
+                face_vertex_ids = [int(c.split("/")[0]) for c in splitted_line[1:]]
+                assert len(face_vertex_ids) == 3
+                faces.append([(ind - 1) if (ind >= 0) else (len(vs) + ind) for ind in face_vertex_ids])
+    return np.asarray(vs), np.asarray(faces, dtype=int)
+
+def baseline_write_obj(path: str, vs: np.ndarray, faces: np.ndarray):
+    """ the original row-by-row Mesh.save """
+    vertices = np.array(vs, dtype=np.float32).flatten()
+    indices = np.array(faces, dtype=np.uint32).flatten()
+    with open(path, "w") as fp:
+        for i in range(0, vertices.size, 3):
+            fp.write("v {0:.8f} {1:.8f} {2:.8f}\n".format(vertices[i], vertices[i + 1], vertices[i + 2]))
+        for i in range(0, len(indices), 3):
+            fp.write("f {0} {1} {2}\n".format(indices[i] + 1, indices[i + 1] + 1, indices[i + 2] + 1))
+
+@pytest.fixture
+def mesh_arrays():
+    rng = np.random.RandomState(0)
+    return rng.normal(size=(50, 3)) * 10.0, rng.randint(0, 50, size=(80, 3))
+
+def test_write_obj_matches_baseline(tmp_path, mesh_arrays):
+    vs, faces = mesh_arrays
+    write_obj(str(tmp_path / "new.obj"), vs, faces)
+    baseline_write_obj(str(tmp_path / "old.obj"), vs, faces)
+    assert (tmp_path / "new.obj").read_bytes() == (tmp_path / "old.obj").read_bytes()
+
+def test_obj_round_trip(tmp_path, mesh_arrays):
+    vs, faces = mesh_arrays
+    path = str(tmp_path / "mesh.obj")
+    write_obj(path, vs, faces)
+    r_vs, r_faces = read_obj(path)
+    assert r_vs.dtype == np.float64 and np.allclose(r_vs, vs.astype(np.float32), rtol=0, atol=1e-6)
+    assert np.array_equal(r_faces, faces)
+
+@pytest.mark.parametrize("text", [
+    "v 0 0 0\nv 1 0 0\nv 0 1 0\nv 1 1 0\nf 1 2 3\nf 2 4 3\n",
+    "# comment\n\n  v 0 0 0 1.0\nvn 0 0 1\nvt 0 0\nv\t1 0 0\nv 0 1 0\nf 1/1/1 2/2/1 3/3/1\nv 1 1 0\nf -3//1 -1//1 -2//1\n",
+    "o mesh\nv 0 0 0\nv 1 0 0\nv 0 1 0\nusemtl m\ns off\nf 1/1 2/2 3/3\n",
+])
+def test_read_obj_matches_baseline(tmp_path, text):
+    path = str(tmp_path / "mesh.obj")
+    with open(path, "w") as f:
+        f.write(text)
+    vs, faces = read_obj(path)
+    ref_vs, ref_faces = baseline_read_obj(path)
+    assert np.array_equal(vs, ref_vs)
+    assert np.array_equal(faces, ref_faces) and faces.dtype == ref_faces.dtype
+
+def test_obj_cache(tmp_path, mesh_arrays):
+    vs, faces = mesh_arrays
+    path = str(tmp_path / "mesh.obj")
+    write_obj(path, vs, faces)
+    first = read_obj_cached(path)
+    assert os.path.exists(cache_path(path))
+    cached = read_obj_cached(path)
+    for a, b in zip(first, cached):
+        assert np.array_equal(a, b)
+
+    # a changed obj rebuilds the sidecar
+    write_obj(path, vs[:10], faces[faces.max(axis=1) < 10])
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 1))
+    r_vs, r_faces = read_obj_cached(path)
+    assert len(r_vs) == 10 and np.array_equal(r_faces, read_obj(path)[1])
+
+    # so does a corrupt one
+    with open(cache_path(path), "wb") as f:
+        f.write(b"not an npz")
+    r_vs, r_faces = read_obj_cached(path)
+    assert np.array_equal(r_vs, read_obj(path)[0])
+    assert np.array_equal(read_obj_cached(path)[0], r_vs)
+
+@pytest.mark.parametrize("binary", [True, False])
+def test_ply_round_trip(tmp_path, mesh_arrays, binary):
+    vs, faces = mesh_arrays
+    rng = np.random.RandomState(1)
+    normal = rng.normal(size=(len(vs), 3))
+    v_attrs = {"normal": normal, "color": rng.randint(0, 256, size=(len(vs), 4)).astype(np.uint8),
+               "quality": rng.rand(len(vs)), "feature": rng.rand(len(vs), 5).astype(np.float32)}
+    f_attrs = {"color": rng.rand(len(faces), 3), "label": rng.randint(-5, 5, size=len(faces))}
+    path = str(tmp_path / "mesh.ply")
+    write_ply(path, vs, faces, vertex_attrs=v_attrs, face_attrs=f_attrs, binary=binary)
+    r_vs, r_faces, r_v, r_f = read_ply(path)
+
+    atol = 0 if binary else 1e-6
+    assert np.allclose(r_vs, vs.astype(np.float32), rtol=0, atol=atol * 10)
+    assert np.array_equal(r_faces, faces)
+    assert sorted(r_v) == sorted(v_attrs) and sorted(r_f) == sorted(f_attrs)
+    assert np.allclose(r_v["normal"], normal.astype(np.float32), rtol=0, atol=atol * 10)
+    assert r_v["color"].dtype == np.uint8 and np.array_equal(r_v["color"], v_attrs["color"])
+    assert np.allclose(r_v["quality"], v_attrs["quality"].astype(np.float32), rtol=0, atol=atol)
+    assert r_v["feature"].shape == (len(vs), 5) and np.allclose(r_v["feature"], v_attrs["feature"], rtol=0, atol=atol)
+    assert r_f["color"].dtype == np.uint8 and np.array_equal(r_f["color"], np.clip(255 * f_attrs["color"], 0, 255).astype(np.uint8))
+    assert np.array_equal(r_f["label"], f_attrs["label"])
+
+def test_ply_without_attributes(tmp_path, mesh_arrays):
+    vs, faces = mesh_arrays
+    path = str(tmp_path / "mesh.ply")
+    write_ply(path, vs, faces)
+    r_vs, r_faces, r_v, r_f = read_ply(path)
+    assert np.array_equal(r_vs, vs.astype(np.float32)) and np.array_equal(r_faces, faces)
+    assert r_v == {} and r_f == {}
+
+def test_read_foreign_ply(tmp_path):
+    header = ["ply", "format {} 1.0", "comment made elsewhere", "element vertex 4", "property double x", "property double y",
+              "property double z", "property uchar red", "property uchar green", "property uchar blue", "element face 2",
+              "property list uint8 uint32 vertex_index", "end_header"]
+    vs = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0.5]])
+    colors = np.array([[255, 0, 0], [0, 255, 0], [0, 0, 255], [9, 9, 9]], dtype=np.uint8)
+    faces = np.array([[0, 1, 2], [1, 3, 2]])
+
+    ascii_path = str(tmp_path / "ascii.ply")
+    with open(ascii_path, "w") as f:
+        f.write("\n".join(header).format("ascii") + "\n")
+        for v, c in zip(vs, colors):
+            f.write("{} {} {} {} {} {}\n".format(*v, *c))
+        for t in faces:
+            f.write("3 {} {} {}\n".format(*t))
+
+    big_path = str(tmp_path / "big.ply")
+    v_data = np.empty(4, dtype=[("x", ">f8"), ("y", ">f8"), ("z", ">f8"), ("red", "u1"), ("green", "u1"), ("blue", "u1")])
+    for i, n in enumerate("xyz"):
+        v_data[n] = vs[:, i]
+    for i, n in enumerate(("red", "green", "blue")):
+        v_data[n] = colors[:, i]
+    f_data = np.empty(2, dtype=[("count", "u1"), ("vertex_index", ">u4", (3,))])
+    f_data["count"], f_data["vertex_index"] = 3, faces
+    with open(big_path, "wb") as f:
+        f.write(("\n".join(header).format("binary_big_endian") + "\n").encode("ascii"))
+        f.write(v_data.tobytes() + f_data.tobytes())
+
+    for path in (ascii_path, big_path):
+        r_vs, r_faces, r_v, r_f = read_ply(path)
+        assert np.array_equal(r_vs, vs) and np.array_equal(r_faces, faces)
+        assert np.array_equal(r_v["color"], colors) and r_f == {}
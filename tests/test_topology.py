@@ -0,0 +1,179 @@
+from collections import Counter
+import numpy as np
+import pytest
+import torch
+
+from util.mesh import Mesh
+from util.meshio import write_obj
+from util.topology import Topology
+
+def torus(n: int, m: int, seed=0):
+    """ closed n x m torus with shuffled faces and jittered vertices """
+    u, v = np.meshgrid(np.arange(n) * 2 * np.pi / n, np.arange(m) * 2 * np.pi / m, indexing="ij")
+    vs = np.stack([(2 + np.cos(v)) * np.cos(u), (2 + np.cos(v)) * np.sin(u), np.sin(v)], axis=-1).reshape(-1, 3)
+    ids = np.arange(n * m).reshape(n, m)
+    a, b = ids, np.roll(ids, -1, axis=0)
+    c, d = np.roll(ids, -1, axis=1), np.roll(b, -1, axis=1)
+    faces = np.concatenate([np.stack([a, b, d], -1).reshape(-1, 3), np.stack([a, d, c], -1).reshape(-1, 3)])
+    rng = np.random.RandomState(seed)
+    return vs + 0.01 * rng.normal(size=vs.shape), faces[rng.permutation(len(faces))]
+
+def grid(n: int, seed=0):
+    """ open n x n height field whose squares are split along either diagonal """
+    rng = np.random.RandomState(seed)
+    x, y = np.meshgrid(np.linspace(0, 1, n), np.linspace(0, 1, n))
+    vs = np.stack([x.ravel(), y.ravel(), 0.1 * rng.normal(size=n * n)], axis=1)
+    ids = np.arange(n * n).reshape(n, n)
+    a, b, c, d = ids[:-1, :-1].ravel(), ids[:-1, 1:].ravel(), ids[1:, :-1].ravel(), ids[1:, 1:].ravel()
+    flip = rng.rand(len(a)) < 0.5
+    t1 = np.where(flip[:, None], np.stack([a, b, c], 1), np.stack([a, b, d], 1))
+    t2 = np.where(flip[:, None], np.stack([b, d, c], 1), np.stack([a, d, c], 1))
+    faces = np.concatenate([t1, t2])
+    return vs, faces[rng.permutation(len(faces))]
+
+def baseline_gemm(faces: np.ndarray, nv: int) -> dict:
+    """ the original loop-based Mesh.build_gemm """
+    ve, vei = [[] for _ in range(nv)], [[] for _ in range(nv)]
+    edge_nb, sides, edge2key, edges, nb_count = [], [], dict(), [], []
+    for face in faces:
+        faces_edges = [tuple(sorted((face[i], face[(i + 1) % 3]))) for i in range(3)]
+        for edge in faces_edges:
+            if edge not in edge2key:
+                edge2key[edge] = len(edges)
+                ve[edge[0]].append(len(edges))
+                ve[edge[1]].append(len(edges))
+                vei[edge[0]].append(0)
+                vei[edge[1]].append(1)
+                edges.append(list(edge))
+                edge_nb.append([-1, -1, -1, -1])
+                sides.append([-1, -1, -1, -1])
+                nb_count.append(0)
+        for idx, edge in enumerate(faces_edges):
+            key = edge2key[edge]
+            edge_nb[key][nb_count[key]] = edge2key[faces_edges[(idx + 1) % 3]]
+            edge_nb[key][nb_count[key] + 1] = edge2key[faces_edges[(idx + 2) % 3]]
+            nb_count[key] += 2
+        for idx, edge in enumerate(faces_edges):
+            key = edge2key[edge]
+            sides[key][nb_count[key] - 2] = nb_count[edge2key[faces_edges[(idx + 1) % 3]]] - 1
+            sides[key][nb_count[key] - 1] = nb_count[edge2key[faces_edges[(idx + 2) % 3]]] - 2
+    return {"edges": np.array(edges, dtype=np.int32), "gemm_edges": np.array(edge_nb, dtype=np.int64),
+            "sides": np.array(sides, dtype=np.int64), "ve": ve, "vei": vei}
+
+def baseline_vf(vs: np.ndarray, faces: np.ndarray, fc: np.ndarray, fa: np.ndarray) -> dict:
+    """ the original loop-based Mesh.build_vf """
+    vf = [set() for _ in range(len(vs))]
+    for i, f in enumerate(faces):
+        for v in f:
+            vf[v].add(i)
+    v2f_inds, v2f_vals, v2f_areas = [[], []], [], []
+    for i in range(len(vf)):
+        v2f_inds[1] += list(vf[i])
+        v2f_inds[0] += [i] * len(vf[i])
+        v2f_vals += (fc[list(vf[i])] - vs[i].reshape(1, -1)).tolist()
+        v2f_areas.append(np.sum(fa[list(vf[i])]))
+    f2f = []
+    for f in faces:
+        count = Counter(list(vf[f[0]]) + list(vf[f[1]]) + list(vf[f[2]]))
+        f2f.append([g for g, c in count.items() if c == 2])
+    return {"vf": vf, "v2f_inds": np.array(v2f_inds), "v2f_vals": np.array(v2f_vals), "v2f_areas": np.array(v2f_areas), "f2f": f2f}
+
+def baseline_cot(vs: np.ndarray, faces: np.ndarray, edges: np.ndarray) -> np.ndarray:
+    """ the original loop-based cotangent matrix of Mesh.build_mesh_lap, as a dense array """
+    e_dict = {(min(e), max(e)): [] for e in edges}
+    for f in faces:
+        s, t, u = vs[f[1]] - vs[f[0]], vs[f[2]] - vs[f[1]], vs[f[0]] - vs[f[2]]
+        cos = [np.inner(s, -u) / (np.linalg.norm(s) * np.linalg.norm(u)),
+               np.inner(t, -s) / (np.linalg.norm(t) * np.linalg.norm(s)),
+               np.inner(u, -t) / (np.linalg.norm(u) * np.linalg.norm(t))]
+        for c, (i, j) in zip(cos, ((1, 2), (2, 0), (0, 1))):
+            e_dict[(min(f[i], f[j]), max(f[i], f[j]))].append(c / (np.sqrt(1 - c ** 2) + 1e-12))
+    C = np.zeros((len(vs), len(vs)))
+    for (i, j), cots in e_dict.items():
+        w = -0.5 * (cots[0] + cots[1])
+        C[i, j] = C[j, i] = w
+        C[i, i] -= w
+        C[j, j] -= w
+    return C
+
+@pytest.fixture(params=["torus", "grid"])
+def mesh(request, tmp_path):
+    vs, faces = torus(12, 9) if request.param == "torus" else grid(9)
+    path = str(tmp_path / "mesh.obj")
+    write_obj(path, vs, faces)
+    return Mesh(path)
+
+def test_gemm_matches_baseline(mesh):
+    ref = baseline_gemm(mesh.faces, len(mesh.vs))
+    assert mesh.edges.dtype == ref["edges"].dtype
+    assert np.array_equal(mesh.edges, ref["edges"])
+    assert np.array_equal(mesh.gemm_edges, ref["gemm_edges"])
+    assert np.array_equal(mesh.sides, ref["sides"])
+    assert mesh.edges_count == len(ref["edges"])
+    assert mesh.ve == ref["ve"]
+    assert mesh.vei == ref["vei"]
+
+def test_vertex_faces_match_baseline(mesh):
+    ref = baseline_vf(mesh.vs, mesh.faces, mesh.fc, mesh.fa)
+    assert mesh.vf == ref["vf"]
+    # the baseline lists each vertex's faces in set order, the topology sorts them by face id
+    order = np.lexsort(ref["v2f_inds"][::-1])
+    inds, vals, areas = mesh.v2f_list
+    assert np.array_equal(inds, ref["v2f_inds"][:, order])
+    assert np.allclose(vals, ref["v2f_vals"][order])
+    assert np.allclose(areas, ref["v2f_areas"])
+    v2f = mesh.v2f_mat.coalesce()
+    assert np.array_equal(v2f.indices().numpy(), ref["v2f_inds"][:, order])
+
+def test_face_faces_match_baseline(mesh):
+    ref = baseline_vf(mesh.vs, mesh.faces, mesh.fc, mesh.fa)["f2f"]
+    for row, neig in zip(mesh.f2f, ref):
+        k = len(neig)
+        assert sorted(row[:k].tolist()) == sorted(neig) and (row[k:] == -1).all()
+    pairs = {(i, j) for i, neig in enumerate(ref) for j in neig}
+    assert set(map(tuple, mesh.f_edges.T.tolist())) == pairs
+    assert mesh.f_edges.shape[1] == len(pairs)
+
+def test_face_neighbours(mesh):
+    ref = baseline_vf(mesh.vs, mesh.faces, mesh.fc, mesh.fa)
+    edge = mesh.topology.face_neighbours("edge", 1)
+    assert [sorted(edge.indices[edge.indptr[i]:edge.indptr[i + 1]].tolist()) for i in range(len(mesh.faces))] == [sorted(n) for n in ref["f2f"]]
+    vert = mesh.topology.face_neighbours("vertex", 1)
+    expected = [sorted(set().union(*(ref["vf"][v] for v in f)) - {i}) for i, f in enumerate(mesh.faces)]
+    assert [vert.indices[vert.indptr[i]:vert.indptr[i + 1]].tolist() for i in range(len(mesh.faces))] == expected
+
+def test_vertex_adjacency(mesh):
+    neig = [set() for _ in mesh.vs]
+    for a, b in mesh.edges:
+        neig[a].add(b)
+        neig[b].add(a)
+    v2v = mesh.v2v_mat.to_dense().numpy()
+    assert [set(np.nonzero(row)[0].tolist()) for row in v2v] == neig
+    assert np.array_equal(mesh.v_dims.numpy(), np.array([len(n) for n in neig], dtype=np.float32))
+
+def test_vertex_normals_match_baseline(mesh):
+    vn = np.zeros((len(mesh.vs), 3))
+    np.add.at(vn, mesh.faces.reshape(-1), np.repeat(mesh.fn, 3, axis=0))
+    vn /= np.linalg.norm(vn, axis=1, keepdims=True)
+    assert np.allclose(mesh.vn, vn)
+
+def test_laplacian_matches_baseline(tmp_path):
+    vs, faces = torus(12, 9)
+    path = str(tmp_path / "torus.obj")
+    write_obj(path, vs, faces)
+    mesh = Mesh(path, build_mat=True)
+    C = baseline_cot(mesh.vs, mesh.faces, mesh.edges)
+    assert np.allclose(mesh.cot_mat.to_dense().numpy(), C.astype(np.float32), rtol=1e-5, atol=1e-6)
+    vf = baseline_vf(mesh.vs, mesh.faces, mesh.fc, mesh.fa)["vf"]
+    minv = np.array([3.0 / (sum(mesh.fa[list(f)]) + 1e-12) for f in vf])
+    L = torch.sparse.mm(torch.sparse_coo_tensor(np.stack([np.arange(len(vs))] * 2), torch.tensor(minv).float(), (len(vs), len(vs))),
+                        torch.tensor(C.astype(np.float32)))
+    assert np.allclose(mesh.mesh_lap.to_dense().numpy(), L.numpy(), rtol=1e-5, atol=1e-5)
+
+def test_shared_topology(mesh):
+    topology = Topology(mesh.faces.copy(), len(mesh.vs))
+    assert topology.matches(mesh.faces, len(mesh.vs))
+    assert not topology.matches(mesh.faces[::-1], len(mesh.vs))
+    moved = mesh.with_vertices(mesh.vs * 2.0)
+    assert moved.topology is mesh.topology
+    assert np.allclose(moved.fa, 4.0 * mesh.fa)
@@ -0,0 +1,113 @@
+import inspect
+import os
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+def _to_cpu(obj):
+    """ copy every tensor of a (nested) state dict to the cpu """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+def rng_state() -> dict:
+    state = {"torch": torch.get_rng_state(), "numpy": np.random.get_state(), "python": random.getstate()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state: dict):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+def training_state(epoch: int, models: dict, optimizers: dict, args=None) -> dict:
+    """ detached cpu copy of the training state after `epoch`, safe to write while training continues """
+    state = {"epoch": epoch, "rng": rng_state()}
+    if args is not None:
+        state["args"] = dict(vars(args))
+    for k, m in models.items():
+        state[k] = _to_cpu(m.state_dict())
+    for k, o in optimizers.items():
+        state[k] = _to_cpu(o.state_dict())
+    return state
+
+def save(state: dict, path: str):
+    """ write a checkpoint atomically, so that a killed run never leaves a truncated file """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _load(path: str, device) -> dict:
+    # the rng states hold numpy arrays and python tuples, which weights-only loading rejects
+    kwargs = {"weights_only": False} if "weights_only" in inspect.signature(torch.load).parameters else {}
+    return torch.load(path, map_location=device, **kwargs)
+
+def load_weights(path: str, models: dict, device) -> int:
+    """ restore only the models of a checkpoint and return its epoch """
+    state = _load(path, device)
+    for k, m in models.items():
+        m.load_state_dict(state[k])
+    return state["epoch"]
+
+def load_args(path: str) -> dict:
+    """ command line arguments the checkpoint was trained with, empty for checkpoints that predate them """
+    return _load(path, "cpu").get("args", {})
+
+def load(path: str, models: dict, optimizers: dict, device) -> int:
+    """ restore models, optimizers and rng from a checkpoint and return its epoch """
+    state = _load(path, device)
+    for k, m in models.items():
+        m.load_state_dict(state[k])
+    for k, o in optimizers.items():
+        o.load_state_dict(state[k])
+    set_rng_state(_to_cpu(state["rng"]))
+    return state["epoch"]
+
+class CheckpointWriter:
+    """ writes checkpoints on a background thread; at most one write is pending at a time """
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                save(*item)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def save(self, state: dict, path: str):
+        """ queue a state from training_state(); blocks only while an earlier write is still queued """
+        self._raise()
+        self._queue.put((state, path))
+
+    def close(self):
+        """ wait for pending writes and stop the thread """
+        self._queue.put(None)
+        self._thread.join()
+        self._raise()
@@ -0,0 +1,54 @@
+import json
+import torch
+
+def normal_change(fn1: torch.Tensor, fn2: torch.Tensor) -> float:
+    """ mean angle in degrees between two sets of unit face normals """
+    inner = torch.clamp(torch.sum(fn1 * fn2, dim=1), -1.0, 1.0)
+    return torch.rad2deg(torch.acos(inner)).mean().item()
+
+class ConvergenceMonitor:
+    """ decides when to stop training: the loss has plateaued, or the face normals barely move between snapshots """
+    def __init__(self, patience=100, rel_tol=1.0e-3, normal_tol=0.01, min_epochs=150):
+        self.patience = patience
+        self.rel_tol = rel_tol
+        self.normal_tol = normal_tol
+        self.min_epochs = min_epochs
+        self.best_loss = None
+        self.best_epoch = None
+        self.last_fn = None
+        self.last_fn_epoch = None
+        self.last_change = None
+        self.stop_epoch = None
+        self.reason = None
+
+    def _stop(self, epoch: int, reason: str) -> bool:
+        self.stop_epoch, self.reason = epoch, reason
+        return True
+
+    def update_loss(self, epoch: int, loss: float) -> bool:
+        """ record the total loss of an epoch; true once it has not improved by rel_tol for `patience` epochs """
+        if epoch < self.min_epochs:
+            return False
+        if self.best_loss is None or loss < self.best_loss - self.rel_tol * abs(self.best_loss):
+            self.best_loss, self.best_epoch = loss, epoch
+            return False
+        if epoch - self.best_epoch >= self.patience:
+            return self._stop(epoch, "loss plateau: no {:.2g} relative improvement on {:.6f} since epoch {}".format(self.rel_tol, self.best_loss, self.best_epoch))
+        return False
+
+    def update_normals(self, epoch: int, fn: torch.Tensor) -> bool:
+        """ record the face normals of a snapshot; true once they change by less than normal_tol degrees per epoch """
+        fn = fn.detach()
+        stop = False
+        if self.last_fn is not None:
+            self.last_change = normal_change(fn, self.last_fn) / (epoch - self.last_fn_epoch)
+            if epoch >= self.min_epochs and self.last_change < self.normal_tol:
+                stop = self._stop(epoch, "normals converged: {:.4f} deg per epoch since epoch {}".format(self.last_change, self.last_fn_epoch))
+        self.last_fn, self.last_fn_epoch = fn, epoch
+        return stop
+
+    def save(self, path: str, **fields):
+        """ write why and when training stopped; without a stop epoch it ran to the end """
+        with open(path, "w") as f:
+            json.dump(dict(fields, stop_epoch=self.stop_epoch, reason=self.reason or "epoch limit", best_loss=self.best_loss,
+                           best_epoch=self.best_epoch, normal_change=self.last_change), f, indent=1)
@@ -1,11 +1,14 @@
 import glob
+import logging
 import numpy as np
 import torch
-from .mesh import Mesh
+from .mesh import Mesh, face_normals
+from .meshio import read_obj, read_obj_cached
 from torch_geometric.data import Data
-from torch.utils.data import DataLoader
 from typing import Tuple
 
+logger = logging.getLogger(__name__)
+
 class Dataset:
     def __init__(self, data):
         self.keys = data.keys
@@ -21,54 +24,74 @@ class Dataset:
         self.edge_index = data['edge_index']
         self.face_index = data['face_index']
 
-class SimpleCustomBatch:
-    def __init__(self, data):
-        transposed_data = list(zip(*data))
-        self.inp = torch.stack(transposed_data[0], 0)
-        self.tgt = torch.stack(transposed_data[1], 0)
-
-    # custom memory pinning method on custom type
-    def pin_memory(self):
-        self.inp = self.inp.pin_memory()
-        self.tgt = self.tgt.pin_memory()
-        return self
-
-def collate_wrapper(batch):
-    return SimpleCustomBatch(batch)
-
-def loader(dataset):
-    print("dataloader")
-    loader = DataLoader(dataset, batch_size=2, collate_fn=collate_wrapper,
-                    pin_memory=True)
-    return loader
-
-def create_dataset(file_path: str) -> Tuple[dict, Dataset]:
+def vertex_noise(nv: int, dim: int, rows: np.ndarray, seed=314, chunk=65536) -> np.ndarray:
+    """ rows of the seeded normal noise create_dataset draws for all nv vertices, without holding all of it """
+    np.random.seed(seed)
+    pos = -np.ones(nv, dtype=np.int64)
+    pos[rows] = np.arange(len(rows))
+    z = np.empty((len(rows), dim))
+    # consecutive draws continue the same stream, so the chunks equal one draw of size (nv, dim)
+    for start in range(0, nv, chunk):
+        block = np.random.normal(size=(min(chunk, nv - start), dim))
+        keep = pos[start:start + len(block)]
+        z[keep[keep >= 0]] = block[keep >= 0]
+    return z
+
+class MeshInputs:
+    """ positions and faces of the noisy and smoothed meshes, enough to build the inputs of any sub-mesh without the full mesh """
+    def __init__(self, mesh_name: str, vs: np.ndarray, faces: np.ndarray, s_vs: np.ndarray):
+        self.mesh_name = mesh_name
+        self.vs = vs
+        self.faces = faces
+        self.s_vs = s_vs
+
+    @classmethod
+    def from_files(cls, file_path: str, use_cache=False) -> "MeshInputs":
+        read = read_obj_cached if use_cache else read_obj
+        n_file = glob.glob(file_path + '/*_noise.obj')[0]
+        s_file = glob.glob(file_path + '/*_smooth.obj')[0]
+        vs, faces = read(n_file)
+        s_vs, _ = read(s_file)
+        return cls(n_file.split('/')[-2], vs, faces, s_vs)
+
+    @classmethod
+    def from_meshes(cls, mesh_dic: dict) -> "MeshInputs":
+        n_mesh = mesh_dic["n_mesh"]
+        return cls(mesh_dic["mesh_name"], n_mesh.vs, n_mesh.faces, mesh_dic["s_mesh"].vs)
+
+    def subset(self, verts: np.ndarray, faces: np.ndarray) -> dict:
+        """ rows of the create_dataset inputs and of the loss targets for the given vertex and face ids """
+        fn, fa = face_normals(self.vs, self.faces[faces])
+        fc = np.sum(self.vs[self.faces[faces]], 1) / 3.0
+        z1 = vertex_noise(len(self.vs), 16, verts)
+        z2 = np.concatenate([fc, fn, fa.reshape(-1, 1)], axis=1)
+        return {
+            "z1": torch.tensor(z1, dtype=torch.float, requires_grad=True),
+            "z2": torch.tensor(z2, dtype=torch.float, requires_grad=True),
+            "x_pos": torch.tensor(self.s_vs[verts], dtype=torch.float),
+            "x_norm": torch.tensor(fn, dtype=torch.float),
+            "n_vs": self.vs[verts],
+            "n_fn": fn,
+        }
+
+def create_dataset(file_path: str, use_cache=False) -> Tuple[dict, Dataset]:
     """ create mesh """
-    with torch.autograd.profiler.profile() as prof:
-        print("meshDictionary")
-        mesh_dic = {}
-    print(prof.key_averages().table(sort_by="self_cpu_time_total"))
-    print("getting file paths")
+    mesh_dic = {}
     n_file = glob.glob(file_path + '/*_noise.obj')[0]
     s_file = glob.glob(file_path + '/*_smooth.obj')[0]
-    print("mesh_names")
     mesh_name = n_file.split('/')[-2]
     gt_file = glob.glob(file_path + '/*_gt.obj')
-    print("checking length of gt file")
+
+    n_mesh = Mesh(n_file, use_cache=use_cache)
+    o1_mesh = n_mesh.with_vertices(n_mesh.vs)
+    s_mesh = Mesh(s_file, use_cache=use_cache, topology=n_mesh.topology)
+
     if len(gt_file) != 0:
-        print("mesh to GT files")
         gt_file = gt_file[0]
-        gt_mesh = Mesh(gt_file)
+        gt_mesh = Mesh(gt_file, use_cache=use_cache, topology=n_mesh.topology)
     else:
         gt_mesh = None
 
-    print("mesh to Noisy Files")
-    n_mesh = Mesh(n_file)
-    o1_mesh = Mesh(n_file)
-    #o2_mesh = Mesh(n_file)
-    s_mesh = Mesh(s_file)
-
-    print("graph creations")
     """ create graph """
     pos_initialization = "rand16"  #["rand6", "rand16", "pos_rand", "norm_rand", "pos_norm"]
     if pos_initialization == "rand6":
@@ -122,9 +145,9 @@ def create_dataset(file_path: str) -> Tuple[dict, Dataset]:
     face_index = torch.from_numpy(n_mesh.f_edges)
 
     """ create dataset """
-    print("initalizing dataset")
     data = Data(x=z1, z1=z1, z2=z2, x_pos=x_pos, x_norm=x_norm, edge_index=edge_index, face_index=face_index)
     dataset = Dataset(data)
+    logger.debug("dataset %s: %d vertices, %d faces, ground truth: %s", mesh_name, len(n_mesh.vs), len(n_mesh.faces), gt_mesh is not None)
 
     mesh_dic["gt_file"] = gt_file
     mesh_dic["n_file"] = n_file
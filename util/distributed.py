@@ -0,0 +1,72 @@
+import os
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+def init(backend="gloo"):
+    """ join the process group set up by torchrun; returns (rank, world_size), (0, 1) when launched directly """
+    world_size = int(os.environ.get("WORLD_SIZE", "1"))
+    if world_size <= 1:
+        return 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group(backend)
+    return dist.get_rank(), dist.get_world_size()
+
+def local_rank() -> int:
+    return int(os.environ.get("LOCAL_RANK", "0"))
+
+def is_enabled() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+def is_main() -> bool:
+    return not is_enabled() or dist.get_rank() == 0
+
+def barrier():
+    if is_enabled():
+        dist.barrier()
+
+def shutdown():
+    if is_enabled():
+        dist.destroy_process_group()
+
+def broadcast_parameters(module: nn.Module):
+    """ copy the parameters and buffers of rank 0 to every rank """
+    if not is_enabled():
+        return
+    for t in list(module.parameters()) + list(module.buffers()):
+        dist.broadcast(t.data, src=0)
+
+def average_gradients(modules: list):
+    """ all-reduce and average the gradients of the given modules in one flat buffer """
+    if not is_enabled():
+        return
+    grads = [p.grad for m in modules for p in m.parameters() if p.grad is not None]
+    if len(grads) == 0:
+        return
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset:offset + g.numel()].view_as(g))
+        offset += g.numel()
+
+def all_reduce_sum(x: torch.Tensor) -> torch.Tensor:
+    """ element-wise sum of a tensor over all ranks """
+    if is_enabled():
+        dist.all_reduce(x)
+    return x
+
+def all_reduce_mean(value: float) -> float:
+    """ mean of a python scalar over all ranks """
+    if not is_enabled():
+        return value
+    x = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(x)
+    return x.item() / dist.get_world_size()
+
+def broadcast(x: torch.Tensor) -> torch.Tensor:
+    """ copy a tensor of rank 0 to every rank; the other ranks pass a tensor of the same shape and dtype """
+    if is_enabled():
+        dist.broadcast(x, src=0)
+    return x
@@ -0,0 +1,146 @@
+import contextlib
+import cProfile
+import inspect
+import io
+import json
+import logging
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+import torch
+
+logger = logging.getLogger(__name__)
+
+PROFILERS = ["off", "torch", "cprofile"]
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+
+_NULL = contextlib.nullcontext()
+_handler = None
+
+def setup_logging(level="INFO"):
+    """ log to the current stderr; calling it again replaces the previous handler """
+    global _handler
+    root = logging.getLogger()
+    if _handler is not None:
+        root.removeHandler(_handler)
+    _handler = logging.StreamHandler(sys.stderr)
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root.addHandler(_handler)
+    root.setLevel(level)
+
+def reset_peak_rss():
+    """ reset the peak resident set size of this process (linux only) """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss_mb() -> float:
+    """ peak resident set size of this process since the last reset """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+class _Stage:
+    def __init__(self, timers: "Timers", name: str):
+        self.timers = timers
+        self.name = name
+
+    def __enter__(self):
+        self.timers.sync()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timers.sync()
+        self.timers.add(self.name, time.perf_counter() - self.start)
+
+class Timers:
+    """ wall-clock time per stage, written as one json line per emit(); does nothing until enabled """
+    def __init__(self):
+        self.enabled = False
+        self.cuda_sync = False
+        self._file = None
+        self._times = {}
+        self._lock = threading.Lock()
+
+    def enable(self, path: str, device=None):
+        self.close()
+        self._file = open(path, "a")
+        self._times = {}
+        self.cuda_sync = device is not None and torch.device(device).type == "cuda"
+        self.enabled = True
+
+    def sync(self):
+        # cuda kernels run asynchronously, so stage boundaries have to wait for them
+        if self.cuda_sync:
+            torch.cuda.synchronize()
+
+    def stage(self, name: str):
+        if not self.enabled:
+            return _NULL
+        return _Stage(self, name)
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self._times[name] = self._times.get(name, 0.0) + seconds
+
+    def emit(self, **fields):
+        """ write the stage times accumulated since the last emit, together with `fields` """
+        if not self.enabled:
+            return
+        with self._lock:
+            times, self._times = self._times, {}
+        self._file.write(json.dumps(dict(fields, **times)) + "\n")
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self.enabled = False
+
+TIMERS = Timers()
+
+def stage(name: str):
+    """ context timing `name` on the global timers """
+    return TIMERS.stage(name)
+
+def emit(**fields):
+    TIMERS.emit(**fields)
+
+@contextlib.contextmanager
+def profiler(mode: str, out_dir: str, device=None):
+    """ run the enclosed code under the torch profiler or cProfile, writing the results to out_dir """
+    assert mode in PROFILERS
+    if mode == "off":
+        yield
+    elif mode == "torch":
+        kwargs = {}
+        if device is not None and torch.device(device).type == "cuda":
+            # newer torch versions replaced use_cuda by use_device
+            params = inspect.signature(torch.autograd.profiler.profile).parameters
+            kwargs = {"use_cuda": True} if "use_cuda" in params else {"use_device": "cuda"}
+        with torch.autograd.profiler.profile(**kwargs) as prof:
+            yield
+        prof.export_chrome_trace(os.path.join(out_dir, "trace.json"))
+        logger.info("\n" + prof.key_averages().table(sort_by="self_cpu_time_total", row_limit=30))
+    else:
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+        prof.dump_stats(os.path.join(out_dir, "profile.prof"))
+        stream = io.StringIO()
+        pstats.Stats(prof, stream=stream).sort_stats("cumulative").print_stats(30)
+        logger.info("\n" + stream.getvalue())
@@ -1,9 +1,10 @@
 import numpy as np
 import torch
-import copy
 import pymeshlab as ml
 from util.mesh import Mesh
-from typing import Union
+from util.topology import TopologyTensors
+from util.models import FaceGeometry
+from typing import Tuple, Union
 from scipy.sparse import csr_matrix
 
 
@@ -13,11 +14,19 @@ def squared_norm(x, dim=None, keepdim=False):
 def norm(x, eps=1.0e-12, dim=None, keepdim=False):
     return torch.sqrt(squared_norm(x, dim=dim, keepdim=keepdim) + eps)
 
-def pos_rec_loss(pred_pos: Union[torch.Tensor, np.ndarray], real_pos: np.ndarray, ltype="rmse") -> torch.Tensor:
+def fp32(x: torch.Tensor) -> torch.Tensor:
+    """ upcast reduced-precision network outputs so that losses accumulate in fp32 """
+    if x.dtype in (torch.float16, torch.bfloat16):
+        return x.float()
+    return x
+
+def pos_rec_loss(pred_pos: Union[torch.Tensor, np.ndarray], real_pos: Union[torch.Tensor, np.ndarray], ltype="rmse") -> torch.Tensor:
     """ reconstructuion error for vertex positions """
     if type(pred_pos) == np.ndarray:
         pred_pos = torch.from_numpy(pred_pos)
-    real_pos = torch.from_numpy(real_pos).to(pred_pos.device)
+    pred_pos = fp32(pred_pos)
+    if type(real_pos) == np.ndarray:
+        real_pos = torch.from_numpy(real_pos).to(pred_pos.device)
 
     if ltype == "l1mae":
         diff_pos = torch.sum(torch.abs(real_pos - pred_pos), dim=1)
@@ -34,11 +43,11 @@ def pos_rec_loss(pred_pos: Union[torch.Tensor, np.ndarray], real_pos: np.ndarray
         exit()
     return loss
 
-def mesh_laplacian_loss(pred_pos: torch.Tensor, mesh: Mesh, ltype="rmse") -> torch.Tensor:
+def mesh_laplacian_loss(pred_pos: torch.Tensor, mesh: Union[Mesh, TopologyTensors], ltype="rmse") -> torch.Tensor:
     """ simple laplacian for output meshes """
-    v2v = mesh.v2v_mat.to(pred_pos.device)
-    v_dims = mesh.v_dims.reshape(-1, 1).to(pred_pos.device)
-    lap_pos = torch.sparse.mm(v2v, pred_pos) / v_dims
+    pred_pos = fp32(pred_pos)
+    mesh_t = mesh.tensors(pred_pos.device)
+    lap_pos = torch.sparse.mm(mesh_t.v2v_mat, pred_pos) / mesh_t.v_dims
     lap_diff = torch.sum((pred_pos - lap_pos) ** 2, dim=1)
     if ltype == "mae":
         lap_diff = torch.sqrt(lap_diff + 1.0e-12)
@@ -56,6 +65,7 @@ def norm_rec_loss(pred_norm: Union[torch.Tensor, np.ndarray], real_norm: Union[t
     """ reconstruction loss for (vertex, face) normal """
     if type(pred_norm) == np.ndarray:
         pred_norm = torch.from_numpy(pred_norm)
+    pred_norm = fp32(pred_norm)
     if type(real_norm) == np.ndarray:
         real_norm = torch.from_numpy(real_norm).to(pred_norm.device)
     
@@ -83,37 +93,33 @@ def norm_rec_loss(pred_norm: Union[torch.Tensor, np.ndarray], real_norm: Union[t
 
     return loss
 
-def fn_bnf_loss(pos: torch.Tensor, fn: torch.Tensor, mesh: Mesh, ltype="l1mae", loop=5) -> torch.Tensor:
-    """ bilateral loss for face normal """
+def fn_bnf_loss(pos: torch.Tensor, fn: torch.Tensor, mesh: Union[Mesh, TopologyTensors], ltype="l1mae", loop=5, geo: FaceGeometry=None, neig="edge", ring=1) -> torch.Tensor:
+    """ bilateral loss for face normal over edge- or vertex-adjacent faces within `ring` rings """
     if type(pos) == np.ndarray:
         pos = torch.from_numpy(pos).to(fn.device)
     else:
-        pos = pos.detach()
-    fc = torch.sum(pos[mesh.faces], 1) / 3.0
-    fa = torch.cross(pos[mesh.faces[:, 1]] - pos[mesh.faces[:, 0]], pos[mesh.faces[:, 2]] - pos[mesh.faces[:, 0]])
-    fa = 0.5 * torch.sqrt(torch.sum(fa**2, axis=1) + 1.0e-12)
+        pos = fp32(pos.detach())
+    fn = fp32(fn)
+    mesh_t = mesh.tensors(fn.device)
+    if geo is None:
+        geo = FaceGeometry(pos, mesh_t.faces)
+    fc = geo.fc.detach()
+    fa = geo.fa.detach()
     
-    f2f = torch.from_numpy(mesh.f2f).long().to(fn.device)
-    no_neig = 1.0 * (f2f != -1)
-    
-    neig_fc = fc[f2f]
-    neig_fa = fa[f2f] * no_neig
-    fc0_tile = fc.reshape(-1, 1, 3)
-    fc_dist = squared_norm(neig_fc - fc0_tile, dim=2)
-    sigma_c = torch.sum(torch.sqrt(fc_dist + 1.0e-12)) / (fc_dist.shape[0] * fc_dist.shape[1])
+    rows, cols = mesh_t.face_pairs(neig, ring)
+    fc_dist = squared_norm(fc[cols] - fc[rows], dim=1)
+    sigma_c = torch.sum(torch.sqrt(fc_dist + 1.0e-12)) / len(fc_dist)
+    sigma_s = 0.3
+    # spatial and area weights are fixed during filtering; only the range weight is updated
+    wca = torch.exp(-1.0 * fc_dist / (2 * (sigma_c ** 2))) * fa[cols]
 
     new_fn = fn
     for i in range(loop):
-        neig_fn = new_fn[f2f]
-        fn0_tile = new_fn.reshape(-1, 1, 3)
-        fn_dist = squared_norm(neig_fn - fn0_tile, dim=2)
-        sigma_s = 0.3
-        wc = torch.exp(-1.0 * fc_dist / (2 * (sigma_c ** 2)))
+        neig_fn = new_fn[cols]
+        fn_dist = squared_norm(neig_fn - new_fn[rows], dim=1)
         ws = torch.exp(-1.0 * fn_dist / (2 * (sigma_s ** 2)))
-        
-        W = torch.stack([wc*ws*neig_fa, wc*ws*neig_fa, wc*ws*neig_fa], dim=2)
 
-        new_fn = torch.sum(W * neig_fn, dim=1)
+        new_fn = torch.zeros_like(fn).index_add(0, rows, (wca * ws).reshape(-1, 1) * neig_fn)
         new_fn = new_fn / (norm(new_fn, dim=1, keepdim=True) + 1.0e-12)
 
     if ltype == "mae":
@@ -137,19 +143,22 @@ def fn_bnf_loss(pos: torch.Tensor, fn: torch.Tensor, mesh: Mesh, ltype="l1mae",
     
     return loss, new_fn
 
-def pos_norm_loss(pos: Union[torch.Tensor, np.ndarray], norm: Union[torch.Tensor, np.ndarray], mesh: Mesh, ltype="mae") -> torch.Tensor:
+def pos_norm_loss(pos: Union[torch.Tensor, np.ndarray], norm: Union[torch.Tensor, np.ndarray], mesh: Union[Mesh, TopologyTensors], ltype="mae", geo: FaceGeometry=None) -> torch.Tensor:
     """ loss between vertex position and face normal """
     if type(pos) == np.ndarray:
         pos = torch.from_numpy(pos)
     if type(norm) == np.ndarray:
         norm = torch.from_numpy(norm).to(pos.device)
-    fc = torch.sum(pos[mesh.faces], 1) / 3.0
-    pc = pos[mesh.faces] - fc.reshape(-1, 1, 3)
+    pos, norm = fp32(pos), fp32(norm)
+    mesh_t = mesh.tensors(pos.device)
+    if geo is None:
+        geo = FaceGeometry(pos, mesh_t.faces)
+    pc = geo.f_pos - geo.fc.reshape(-1, 1, 3)
     dot_f2v = torch.abs(torch.sum(pc * norm.reshape(-1, 1, 3), dim=2))
     mat_vals = dot_f2v.reshape(-1)
 
     if ltype == "mae":
-        loss = torch.sum(mat_vals) / len(mesh.vs)
+        loss = torch.sum(mat_vals) / mesh_t.nv
     elif ltype == "rmse":
         loss = torch.sum(mat_vals ** 2) / len(mat_vals)
         loss = torch.sqrt(loss + 1.0e-6)
@@ -196,71 +205,53 @@ def weighted_pos_norm_loss(pos: Union[torch.Tensor, np.ndarray], norm: Union[tor
     return loss
 
 
-def bnf(fn: Union[torch.Tensor, np.ndarray], mesh: Mesh, sigma_s=0.7, sigma_c=0.2, iter=1) -> torch.Tensor:
-    """ bilateral normal filtering """
+def bnf_vertices(fn: Union[torch.Tensor, np.ndarray], mesh: Mesh, sigma_s=0.7, sigma_c=0.2, iter=1) -> Tuple[np.ndarray, np.ndarray]:
+    """ bilateral normal filtering, returning filtered face normals and updated vertex positions """
     if type(fn) == torch.Tensor:
         fn = fn.to("cpu").detach().numpy().copy()
     new_fn = fn
-    new_mesh = copy.deepcopy(mesh)
+    vs = np.array(mesh.vs, dtype=np.float64)
+    faces = mesh.faces
+    f2f = mesh.f2f
+    no_neig = 1.0 * (f2f != -1)
+    vf_verts = mesh.topology.vf_verts
+    vf_faces = mesh.topology.vf_faces
+    vf_indptr = mesh.topology.vf_indptr
 
     for _ in range(iter):
-        vs = new_mesh.vs
-        vf = new_mesh.vf
-        fc = new_mesh.fc
-        fa = new_mesh.fa
-        f2f = new_mesh.f2f
-        
+        fc = np.sum(vs[faces], 1) / 3.0
+        fa = np.cross(vs[faces[:, 1]] - vs[faces[:, 0]], vs[faces[:, 2]] - vs[faces[:, 0]])
+        fa = 0.5 * np.linalg.norm(fa, axis=1)
+
         neig_fc = fc[f2f]
-        neig_fa = fa[f2f]
-        fc0_tile = np.tile(fc, (1, 3)).reshape(-1, 3, 3)
-        fc_dist = np.linalg.norm(neig_fc - fc0_tile, axis=2)
+        neig_fa = fa[f2f] * no_neig
+        fc_dist = np.linalg.norm(neig_fc - fc.reshape(-1, 1, 3), axis=2)
         
         """ normal updating """
         neig_fn = new_fn[f2f]
-        fn0_tile = np.tile(new_fn, (1, 3)).reshape(-1, 3, 3)
-        fn_dist = np.linalg.norm(neig_fn - fn0_tile, axis=2)
+        fn_dist = np.linalg.norm(neig_fn - new_fn.reshape(-1, 1, 3), axis=2)
 
         wc = np.exp(-1.0 * (fc_dist ** 2) / (2 * (sigma_c ** 2)))
         ws = np.exp(-1.0 * (fn_dist ** 2) / (2 * (sigma_s ** 2)))
-        
-        W = np.stack([wc*ws*neig_fa, wc*ws*neig_fa, wc*ws*neig_fa], 2)
+        W = (wc * ws * neig_fa).reshape(-1, 3, 1)
 
         new_fn = np.sum(W * neig_fn, 1)
         new_fn = new_fn / (np.linalg.norm(new_fn, axis=1, keepdims=True) + 1.0e-12)
 
         """ vertex updating """
-        # TODO: fix bug for high-speed computation
-        if iter == -1:
-            v2f_inds = np.array(new_mesh.v2f_list[0])
-            v2f_vals = np.array(new_mesh.v2f_list[1])
-            v2f_areas = np.array(new_mesh.v2f_list[2]).reshape(-1, 1)
-            nk = new_fn[v2f_inds[1]]
-            ak = fa[v2f_inds[1]]
-            v2f_data = np.sum(nk * v2f_vals, 1) * ak
-            v2f_mat = csr_matrix((v2f_data, v2f_inds), shape=(len(vs), len(new_fn)))
-            d_vs = v2f_mat * new_fn
-            d_vs /= (v2f_areas + 1.0e-12)
-            new_mesh.vs += d_vs
-            Mesh.compute_face_center(new_mesh)
-            Mesh.compute_face_normals(new_mesh)
-        
-        #TODO: use this temporarily (slow!)
-        else:
-            for v in range(len(vs)):
-                f_list = list(vf[v])
-                fc_v = fc[f_list]
-                new_fn_v = new_fn[f_list]
-                sumArea = np.sum(fa[f_list])
-                incr = fa[f_list] * np.sum(new_fn_v * (fc_v - vs[v].reshape(-1, 3)), 1)
-                incr = incr.reshape(-1, 1) * new_fn_v
-                incr = np.sum(incr, 0)
-                incr /= sumArea
-                new_mesh.vs[v] += incr
-            if iter > 1:
-                Mesh.compute_face_center(new_mesh)
-                Mesh.compute_face_normals(new_mesh)
-
-    return new_fn, new_mesh
+        nk = new_fn[vf_faces]
+        ak = fa[vf_faces]
+        v2f_data = np.sum(nk * (fc[vf_faces] - vs[vf_verts]), 1) * ak
+        v2f_mat = csr_matrix((v2f_data, vf_faces, vf_indptr), shape=(len(vs), len(faces)))
+        v2f_areas = np.bincount(vf_verts, weights=ak, minlength=len(vs)).reshape(-1, 1)
+        vs += v2f_mat.dot(new_fn) / (v2f_areas + 1.0e-12)
+
+    return new_fn, vs
+
+def bnf(fn: Union[torch.Tensor, np.ndarray], mesh: Mesh, sigma_s=0.7, sigma_c=0.2, iter=1) -> Tuple[np.ndarray, Mesh]:
+    """ bilateral normal filtering """
+    new_fn, new_vs = bnf_vertices(fn, mesh, sigma_s=sigma_s, sigma_c=sigma_c, iter=iter)
+    return new_fn, mesh.with_vertices(new_vs)
 
 def mad(norm1: Union[np.ndarray, torch.Tensor], norm2: Union[np.ndarray, torch.Tensor]) -> np.ndarray:
     """ mean angular distance for (face, vertex) normals """
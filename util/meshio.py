@@ -0,0 +1,241 @@
+import os
+import re
+import numpy as np
+from typing import Tuple
+
+_V_LINE = re.compile(r"^[ \t]*v[ \t]+(.*)$", re.M)
+_F_LINE = re.compile(r"^[ \t]*f[ \t]+(.*)$", re.M)
+_F_TEX_NORM = re.compile(r"/\S*")
+CACHE_EXT = ".npz"
+
+def _parse_rows(rows: list, dtype, ncols=None, strip_slash=False) -> np.ndarray:
+    """ parse whitespace-separated rows at once, falling back to row-by-row parsing """
+    if len(rows) == 0:
+        return np.zeros((0, ncols or 3), dtype=dtype)
+    text = "\n".join(rows)
+    if strip_slash and "/" in text:
+        text = _F_TEX_NORM.sub("", text)
+        rows = text.split("\n")
+    first = len(rows[0].split())
+    data = np.fromstring(text, dtype=dtype, sep=" ")
+    if data.size == len(rows) * first:
+        data = data.reshape(len(rows), first)
+    else:
+        data = [np.array(r.split()[:ncols], dtype=dtype) for r in rows]
+        assert ncols is not None or len(set(len(d) for d in data)) == 1
+        data = np.stack(data)
+    return data[:, :ncols] if ncols is not None else data
+
+def read_obj(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """ read vertex positions and triangles from an obj file """
+    with open(path) as f:
+        text = f.read()
+
+    vs = _parse_rows(_V_LINE.findall(text), float, ncols=3).astype(np.float64)
+    faces = _parse_rows(_F_LINE.findall(text), np.int64, strip_slash=True)
+    assert faces.shape[1] == 3
+
+    # obj indices are 1-based; negative indices count back from the last vertex read so far
+    neg = faces < 0
+    if neg.any():
+        v_pos = np.array([m.start() for m in _V_LINE.finditer(text)])
+        f_pos = np.array([m.start() for m in _F_LINE.finditer(text)])
+        v_seen = np.searchsorted(v_pos, f_pos).reshape(-1, 1)
+        faces = np.where(neg, faces + v_seen, faces - 1)
+    else:
+        faces = faces - 1
+    faces = faces.astype(int)
+
+    assert np.logical_and(faces >= 0, faces < len(vs)).all()
+    return vs, faces
+
+def write_obj(path: str, vs: np.ndarray, faces: np.ndarray):
+    """ write vertex positions and triangles to an obj file """
+    vertices = np.array(vs, dtype=np.float32).reshape(-1, 3)
+    indices = np.array(faces, dtype=np.uint32).reshape(-1, 3) + 1
+    with open(path, "w") as fp:
+        fp.write(("v %.8f %.8f %.8f\n" * len(vertices)) % tuple(vertices.ravel().tolist()))
+        fp.write(("f %d %d %d\n" * len(indices)) % tuple(indices.ravel().tolist()))
+
+def cache_path(path: str) -> str:
+    return path + CACHE_EXT
+
+def _stamp(path: str) -> np.ndarray:
+    st = os.stat(path)
+    return np.array([st.st_mtime_ns, st.st_size], dtype=np.int64)
+
+def read_obj_cached(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """ read an obj file through a binary sidecar that is rebuilt whenever the obj changes """
+    c_path = cache_path(path)
+    stamp = _stamp(path)
+    if os.path.exists(c_path):
+        try:
+            with np.load(c_path) as cache:
+                if np.array_equal(cache["stamp"], stamp):
+                    return cache["vs"], cache["faces"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    vs, faces = read_obj(path)
+    tmp_path = "{}.{}.tmp".format(c_path, os.getpid())
+    try:
+        with open(tmp_path, "wb") as fp:
+            np.savez(fp, vs=vs, faces=faces, stamp=stamp)
+        os.replace(tmp_path, c_path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return vs, faces
+
+_PLY_TYPES = {
+    "char": "i1", "uchar": "u1", "short": "i2", "ushort": "u2", "int": "i4", "uint": "u4", "float": "f4", "double": "f8",
+    "int8": "i1", "uint8": "u1", "int16": "i2", "uint16": "u2", "int32": "i4", "uint32": "u4", "float32": "f4", "float64": "f8",
+}
+_PLY_NAMES = {"i1": "char", "u1": "uchar", "i2": "short", "u2": "ushort", "i4": "int", "u4": "uint", "f4": "float", "f8": "double"}
+_PLY_COLUMNS = {"normal": ["nx", "ny", "nz"], "color": ["red", "green", "blue", "alpha"]}
+
+def _ply_columns(attrs: dict) -> list:
+    """ (property name, values) per column; normals and colors get the usual ply names, other matrices name_0, name_1, ... """
+    columns = []
+    for name, values in (attrs or {}).items():
+        values = np.asarray(values)
+        if name == "color" and values.dtype.kind == "f":
+            values = np.clip(255 * values, 0, 255).astype(np.uint8)
+        elif values.dtype == np.float64:
+            values = values.astype(np.float32)
+        elif values.dtype == np.int64:
+            values = values.astype(np.int32)
+        if values.ndim == 1:
+            columns.append((name, values))
+            continue
+        names = _PLY_COLUMNS.get(name, [])
+        if values.shape[1] > len(names):
+            names = ["{}_{}".format(name, i) for i in range(values.shape[1])]
+        columns += [(names[i], values[:, i]) for i in range(values.shape[1])]
+    return columns
+
+def _ply_group(columns: dict) -> dict:
+    """ inverse of _ply_columns: gather normals, colors and numbered columns back into matrices """
+    attrs = {}
+    for key, group in _PLY_COLUMNS.items():
+        group = [g for g in group if g in columns]
+        if len(group) >= 3:
+            attrs[key] = np.stack([columns.pop(g) for g in group], axis=1)
+    for name in list(columns):
+        if name not in columns:
+            continue
+        if not name.endswith("_0"):
+            attrs[name] = columns.pop(name)
+            continue
+        base, group = name[:-2], []
+        while "{}_{}".format(base, len(group)) in columns:
+            group.append("{}_{}".format(base, len(group)))
+        attrs[base] = np.stack([columns.pop(g) for g in group], axis=1)
+    return attrs
+
+def write_ply(path: str, vs: np.ndarray, faces: np.ndarray, vertex_attrs: dict=None, face_attrs: dict=None, binary=True):
+    """ write triangles and optional per-vertex / per-face properties (normals, colors, scalar fields) to a ply file """
+    vs = np.asarray(vs, dtype=np.float32).reshape(-1, 3)
+    faces = np.asarray(faces, dtype=np.int32).reshape(-1, 3)
+    v_cols = [("x", vs[:, 0]), ("y", vs[:, 1]), ("z", vs[:, 2])] + _ply_columns(vertex_attrs)
+    f_cols = [("vertex_indices", faces)] + _ply_columns(face_attrs)
+    for _, values in v_cols:
+        assert len(values) == len(vs), "one value per vertex expected"
+    for _, values in f_cols:
+        assert len(values) == len(faces), "one value per face expected"
+
+    header = ["ply", "format {} 1.0".format("binary_little_endian" if binary else "ascii"), "element vertex {}".format(len(vs))]
+    header += ["property {} {}".format(_PLY_NAMES[v.dtype.str[1:]], n) for n, v in v_cols]
+    header += ["element face {}".format(len(faces)), "property list uchar int vertex_indices"]
+    header += ["property {} {}".format(_PLY_NAMES[v.dtype.str[1:]], n) for n, v in f_cols[1:]]
+    header += ["end_header"]
+
+    v_data = np.empty(len(vs), dtype=[(n, "<" + v.dtype.str[1:]) for n, v in v_cols])
+    for n, v in v_cols:
+        v_data[n] = v
+    f_data = np.empty(len(faces), dtype=[("count", "u1"), ("vertex_indices", "<i4", (3,))] + [(n, "<" + v.dtype.str[1:]) for n, v in f_cols[1:]])
+    f_data["count"] = 3
+    for n, v in f_cols:
+        f_data[n] = v
+
+    with open(path, "wb") as fp:
+        fp.write(("\n".join(header) + "\n").encode("ascii"))
+        if binary:
+            fp.write(v_data.tobytes())
+            fp.write(f_data.tobytes())
+            return
+        # one % over the whole table instead of a write per row
+        for data, cols in ((v_data, v_cols), (f_data, [("count", f_data["count"])] + f_cols)):
+            fmt = " ".join(("%d %d %d" if n == "vertex_indices" else "%.6f" if v.dtype.kind == "f" else "%d") for n, v in cols) + "\n"
+            values = np.concatenate([data[n].reshape(len(data), -1).astype(np.float64) for n, _ in cols], axis=1)
+            fp.write(((fmt * len(data)) % tuple(values.ravel().tolist())).encode("ascii"))
+
+def read_ply(path: str) -> Tuple[np.ndarray, np.ndarray, dict, dict]:
+    """ read a triangle ply file (ascii or binary) written by write_ply or other tools; returns vs, faces, vertex and face properties """
+    with open(path, "rb") as fp:
+        assert fp.readline().strip() == b"ply", "not a ply file"
+        fmt, elements = None, []
+        while True:
+            line = fp.readline()
+            assert line, "ply header has no end_header"
+            words = line.decode("ascii").split()
+            if len(words) == 0 or words[0] in ("comment", "obj_info"):
+                continue
+            if words[0] == "end_header":
+                break
+            if words[0] == "format":
+                fmt = words[1]
+            elif words[0] == "element":
+                elements.append((words[1], int(words[2]), []))
+            elif words[0] == "property" and words[1] == "list":
+                elements[-1][2].append((words[4], _PLY_TYPES[words[2]], _PLY_TYPES[words[3]]))
+            elif words[0] == "property":
+                elements[-1][2].append((words[2], _PLY_TYPES[words[1]], None))
+        body = fp.read()
+
+    # lists are assumed to hold triangles, which makes every element a fixed-size record
+    data = {}
+    if fmt == "ascii":
+        table = np.fromstring(body.decode("ascii"), dtype=np.float64, sep=" ")
+        start = 0
+        for name, count, props in elements:
+            width = sum(4 if lt is not None else 1 for _, _, lt in props)
+            rows = table[start:start + count * width].reshape(count, width)
+            start += count * width
+            cols, i = {}, 0
+            for p, t, lt in props:
+                if lt is not None:
+                    assert (rows[:, i] == 3).all(), "only triangle meshes are supported"
+                    cols[p] = rows[:, i + 1:i + 4].astype(lt)
+                    i += 4
+                else:
+                    cols[p] = rows[:, i].astype(t)
+                    i += 1
+            data[name] = cols
+    else:
+        assert fmt in ("binary_little_endian", "binary_big_endian"), "unknown ply format {}".format(fmt)
+        order = "<" if fmt == "binary_little_endian" else ">"
+        offset = 0
+        for name, count, props in elements:
+            dtype = []
+            for p, t, lt in props:
+                if lt is not None:
+                    dtype += [(p + "_count", t), (p, order + lt, (3,))]
+                else:
+                    dtype.append((p, order + t))
+            rows = np.frombuffer(body, dtype=dtype, count=count, offset=offset)
+            offset += rows.nbytes
+            cols = {}
+            for p, t, lt in props:
+                if lt is not None:
+                    assert (rows[p + "_count"] == 3).all(), "only triangle meshes are supported"
+                    cols[p] = rows[p].astype(lt)
+                else:
+                    cols[p] = rows[p].astype(t)
+            data[name] = cols
+
+    v_cols, f_cols = data.get("vertex", {}), data.get("face", {})
+    vs = np.stack([v_cols.pop("x"), v_cols.pop("y"), v_cols.pop("z")], axis=1).astype(np.float64)
+    faces = f_cols.pop("vertex_indices") if "vertex_indices" in f_cols else f_cols.pop("vertex_index", np.zeros((0, 3)))
+    faces = faces.astype(int)
+    return vs, faces, _ply_group(v_cols), _ply_group(f_cols)
@@ -1,44 +1,72 @@
 import numpy as np
 import torch
 from util.mesh import Mesh
+from typing import Union
     
+class FaceGeometry:
+    """ face corners, centers, areas and normals from a single gather of vertex positions """
+    def __init__(self, vs: torch.Tensor, faces: Union[torch.Tensor, np.ndarray]):
+        self.f_pos = vs[faces]
+        self.fc = torch.sum(self.f_pos, 1) / 3.0
+        self._fn_raw = None
+        self._fa = None
+        self._fn = None
+
+    def _compute_normals(self):
+        f_pos = self.f_pos
+        self._fn_raw = torch.cross(f_pos[:, 1] - f_pos[:, 0], f_pos[:, 2] - f_pos[:, 0], dim=1)
+        fn_len = torch.sqrt(torch.sum(self._fn_raw ** 2, dim=1, keepdim=True) + 1.0e-12)
+        self._fa = 0.5 * fn_len.reshape(-1)
+        self._fn = self._fn_raw / fn_len
+
+    @property
+    def fn_raw(self) -> torch.Tensor:
+        """ unnormalized face normals (twice the area vector) """
+        if self._fn_raw is None:
+            self._compute_normals()
+        return self._fn_raw
+
+    @property
+    def fa(self) -> torch.Tensor:
+        if self._fa is None:
+            self._compute_normals()
+        return self._fa
+
+    @property
+    def fn(self) -> torch.Tensor:
+        if self._fn is None:
+            self._compute_normals()
+        return self._fn
+
 def compute_fn(vs: torch.Tensor, faces: np.ndarray) -> torch.Tensor:
     """ compute face normals from mesh with Tensor """
-    face_normals = torch.cross(vs[faces[:, 1]] - vs[faces[:, 0]], vs[faces[:, 2]] - vs[faces[:, 0]])
-    norm = torch.sqrt(torch.sum(face_normals**2, dim=1))
-    face_normals = face_normals / norm.repeat(3, 1).T
-    return face_normals
+    return FaceGeometry(vs, faces).fn
 
-def compute_vn(vs: torch.Tensor, fn: torch.Tensor, faces: np.ndarray) -> torch.Tensor:
+def compute_vn(vs: torch.Tensor, fn: torch.Tensor, faces: Union[torch.Tensor, np.ndarray]) -> torch.Tensor:
     """ compute vertex normals from mesh with Tensor"""
-    vert_normals = torch.zeros((3, len(vs)))
-    face_normals = fn
-    faces = torch.from_numpy(faces).long().to(vs.device)
-
-    nv = len(vs)
-    nf = len(faces)
-    mat_rows = torch.reshape(faces, (-1,)).to(vs.device)
-    mat_cols = torch.tensor([[i] * 3 for i in range(nf)]).reshape(-1).to(vs.device)
-    mat_vals = torch.ones(len(mat_rows)).to(vs.device)
-    f2v_mat = torch.sparse.FloatTensor(torch.stack([mat_rows, mat_cols], dim=0),
-                                        mat_vals,
-                                        size=torch.Size([nv, nf]))
-    vert_normals = torch.sparse.mm(f2v_mat, face_normals)
+    if type(faces) == np.ndarray:
+        faces = torch.from_numpy(faces)
+    faces = faces.long().to(vs.device)
+    corner_fn = fn.reshape(-1, 1, 3).expand(-1, 3, -1).reshape(-1, 3)
+    vert_normals = torch.zeros((len(vs), 3), dtype=fn.dtype, device=fn.device).index_add(0, faces.reshape(-1), corner_fn)
     norm = torch.sqrt(torch.sum(vert_normals**2, dim=1))                    
     vert_normals = vert_normals / norm.repeat(3, 1).T
     return vert_normals
 
 def vertex_updating(pos: torch.Tensor, norm: torch.Tensor, mesh: Mesh, loop=10) -> torch.Tensor:
-    new_pos = pos.detach().clone()
-    norm = norm.detach().clone()
+    """ move vertices toward the planes of their adjacent faces (all vertices at once) """
+    faces = torch.from_numpy(mesh.faces).long().to(pos.device)
+    vf_verts = torch.from_numpy(mesh.topology.vf_verts).long().to(pos.device)
+    vf_faces = torch.from_numpy(mesh.topology.vf_faces).long().to(pos.device)
+    vf_counts = torch.from_numpy(mesh.topology.vf_counts).to(pos.device)
+    vf_counts = torch.clamp(vf_counts, min=1).reshape(-1, 1).to(pos.dtype)
+    nis = norm[vf_faces]
+
+    new_pos = pos
     for iter in range(loop):
-        fc = torch.sum(new_pos[mesh.faces], 1) / 3.0
-        for i in range(len(new_pos)):
-            cis = fc[list(mesh.vf[i])]
-            nis = norm[list(mesh.vf[i])]
-            cvis = cis - new_pos[i].reshape(1, -1)
-            ncvis = torch.sum(nis * cvis, dim=1)
-            dvi = torch.sum(ncvis.reshape(-1, 1) * nis, dim=0)
-            dvi /= len(mesh.vf[i])
-            new_pos[i] += dvi
+        fc = torch.sum(new_pos[faces], 1) / 3.0
+        cvis = fc[vf_faces] - new_pos[vf_verts]
+        ncvis = torch.sum(nis * cvis, dim=1)
+        dvi = torch.zeros_like(new_pos).index_add(0, vf_verts, ncvis.reshape(-1, 1) * nis)
+        new_pos = new_pos + dvi / vf_counts
     return new_pos
@@ -1,29 +1,117 @@
+import contextlib
+import inspect
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 import numpy as np
 from torch_geometric.nn import GCNConv
+from torch_geometric.nn.conv.gcn_conv import gcn_norm
 from torch_scatter import scatter_max
 from sklearn.preprocessing import normalize
 
+def autocast(precision: str, device: torch.device):
+    """ context running the networks in bf16 autocast, or a no-op for fp32 """
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    assert precision == "bf16"
+    assert hasattr(torch, "autocast"), "bf16 autocast requires torch >= 1.10"
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+
+def gcn_adjacency(edge_index: torch.Tensor, num_nodes: int):
+    """ symmetric-normalized adjacency with self loops as (edge_index, edge_weight) """
+    return gcn_norm(edge_index, None, num_nodes, improved=False, add_self_loops=True)
+
+def autocast_dtype(device: torch.device):
+    """ dtype of the autocast region active on the device type, or None outside autocast """
+    if hasattr(torch, "get_autocast_dtype"):
+        enabled, dtype = torch.is_autocast_enabled(device.type), torch.get_autocast_dtype(device.type)
+    elif device.type == "cpu":
+        enabled, dtype = torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype()
+    else:
+        enabled, dtype = torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype()
+    return dtype if enabled else None
+
+def cached_adjacency(cache: dict, edge_index: torch.Tensor, num_nodes: int, device):
+    """ normalized graph operator, built once per input graph (full mesh or patch) and shared by all layers """
+    # keyed by identity; the stored edge_index keeps its id from being reused by another graph
+    entry = cache.get(id(edge_index))
+    if entry is None or entry[0] is not edge_index:
+        entry = cache[id(edge_index)] = (edge_index, gcn_adjacency(edge_index.to(device), num_nodes), {})
+    index, weight = entry[1]
+    # under autocast the fp32 weights would promote every message and aggregation back to fp32
+    dtype = autocast_dtype(torch.device(device))
+    if dtype is not None and dtype != weight.dtype:
+        if dtype not in entry[2]:
+            entry[2][dtype] = weight.to(dtype)
+        weight = entry[2][dtype]
+    return index, weight
+
+@contextlib.contextmanager
+def frozen_batchnorm(bns: list):
+    """ keep batchnorm layers in training mode but leave their running statistics untouched """
+    state = [(bn.momentum, bn.num_batches_tracked.clone()) for bn in bns]
+    for bn in bns:
+        bn.momentum = 0.0
+    try:
+        yield
+    finally:
+        for bn, (momentum, tracked) in zip(bns, state):
+            bn.momentum = momentum
+            bn.num_batches_tracked.copy_(tracked)
+
+class _Segment:
+    """ a run of (conv, bn) blocks that may be recomputed during backward """
+    def __init__(self, blocks: list, act: nn.Module):
+        self.blocks = blocks
+        self.act = act
+        self.recompute = False
+
+    def __call__(self, x, edge_index, edge_weight):
+        # the recomputation in backward must not update the batchnorm running statistics twice
+        with frozen_batchnorm([bn for _, bn in self.blocks]) if self.recompute else contextlib.nullcontext():
+            for conv, bn in self.blocks:
+                x = self.act(bn(conv(x, edge_index, edge_weight)))
+        self.recompute = True
+        return x
+
+def _checkpoint(fn, *args):
+    if "use_reentrant" in inspect.signature(checkpoint).parameters:
+        return checkpoint(fn, *args, use_reentrant=False)
+    return checkpoint(fn, *args)
+
+def run_blocks(blocks: list, x: torch.Tensor, edge_index: torch.Tensor, edge_weight: torch.Tensor, act: nn.Module, segments=0) -> torch.Tensor:
+    """ apply (conv, bn, act) blocks; with segments > 0 all but the last segment are recomputed in backward """
+    if segments <= 0:
+        for conv, bn in blocks:
+            x = act(bn(conv(x, edge_index, edge_weight)))
+        return x
+
+    size = -(-len(blocks) // segments)
+    chunks = [blocks[i:i + size] for i in range(0, len(blocks), size)]
+    for chunk in chunks[:-1]:
+        x = _checkpoint(_Segment(chunk, act), x, edge_index, edge_weight)
+    return _Segment(chunks[-1], act)(x, edge_index, edge_weight)
+
 class PosNet(nn.Module):
-    def __init__(self, device):
+    def __init__(self, device, checkpoint_segments=0):
         super(PosNet, self).__init__()
         self.device = device
+        self.checkpoint_segments = checkpoint_segments
         
         h = [16, 32, 64, 128, 256, 256, 512, 512, 256, 256, 128, 64, 32, 16, 3]
 
-        self.conv1  = GCNConv(h[0], h[1])
-        self.conv2  = GCNConv(h[1], h[2])
-        self.conv3  = GCNConv(h[2], h[3])
-        self.conv4  = GCNConv(h[3], h[4])
-        self.conv5  = GCNConv(h[4], h[5])
-        self.conv6  = GCNConv(h[5], h[6])
-        self.conv7  = GCNConv(h[6], h[7])
-        self.conv8  = GCNConv(h[7], h[8])
-        self.conv9  = GCNConv(h[8], h[9])
-        self.conv10 = GCNConv(h[9], h[10])
-        self.conv11 = GCNConv(h[10], h[11])
-        self.conv12 = GCNConv(h[11], h[12])
+        self.conv1  = GCNConv(h[0], h[1], normalize=False)
+        self.conv2  = GCNConv(h[1], h[2], normalize=False)
+        self.conv3  = GCNConv(h[2], h[3], normalize=False)
+        self.conv4  = GCNConv(h[3], h[4], normalize=False)
+        self.conv5  = GCNConv(h[4], h[5], normalize=False)
+        self.conv6  = GCNConv(h[5], h[6], normalize=False)
+        self.conv7  = GCNConv(h[6], h[7], normalize=False)
+        self.conv8  = GCNConv(h[7], h[8], normalize=False)
+        self.conv9  = GCNConv(h[8], h[9], normalize=False)
+        self.conv10 = GCNConv(h[9], h[10], normalize=False)
+        self.conv11 = GCNConv(h[10], h[11], normalize=False)
+        self.conv12 = GCNConv(h[11], h[12], normalize=False)
 
         self.linear1 = nn.Linear(h[12], h[13])
         self.linear2 = nn.Linear(h[13], h[14])
@@ -42,24 +130,17 @@ class PosNet(nn.Module):
         self.bn12 = nn.BatchNorm1d(h[12])
 
         self.l_relu = nn.LeakyReLU()
-            
+        self._adj = {}
+
+    def blocks(self) -> list:
+        return [(getattr(self, "conv%d" % i), getattr(self, "bn%d" % i)) for i in range(1, 13)]
 
     def forward(self, data):
 
-        z1, x_pos, edge_index = data.z1.to(self.device), data.x_pos.to(self.device), data.edge_index.to(self.device)
+        z1, x_pos = data.z1.to(self.device), data.x_pos.to(self.device)
+        edge_index, edge_weight = cached_adjacency(self._adj, data.edge_index, z1.shape[0], self.device)
         n1 = torch.randn(x_pos.shape[0], x_pos.shape[1]).to(self.device) * 1e-5
-        dx = self.l_relu(self.bn1(self.conv1(z1, edge_index)))
-        dx = self.l_relu(self.bn2(self.conv2(dx, edge_index)))
-        dx = self.l_relu(self.bn3(self.conv3(dx, edge_index)))
-        dx = self.l_relu(self.bn4(self.conv4(dx, edge_index)))
-        dx = self.l_relu(self.bn5(self.conv5(dx, edge_index)))
-        dx = self.l_relu(self.bn6(self.conv6(dx, edge_index)))
-        dx = self.l_relu(self.bn7(self.conv7(dx, edge_index)))
-        dx = self.l_relu(self.bn8(self.conv8(dx, edge_index)))
-        dx = self.l_relu(self.bn9(self.conv9(dx, edge_index)))
-        dx = self.l_relu(self.bn10(self.conv10(dx, edge_index)))
-        dx = self.l_relu(self.bn11(self.conv11(dx, edge_index)))
-        dx = self.l_relu(self.bn12(self.conv12(dx, edge_index)))
+        dx = run_blocks(self.blocks(), z1, edge_index, edge_weight, self.l_relu, self.checkpoint_segments if self.training else 0)
         
         dx = self.l_relu(self.linear1(dx))
         dx = self.linear2(dx)
@@ -67,24 +148,25 @@ class PosNet(nn.Module):
         return x_pos + dx
 
 class NormalNet(nn.Module):
-    def __init__(self, device):
+    def __init__(self, device, checkpoint_segments=0):
         super(NormalNet, self).__init__()
         self.device = device
+        self.checkpoint_segments = checkpoint_segments
         
         h = [7, 32, 64, 128, 256, 256, 512, 512, 256, 256, 128, 64, 32, 16, 3]
 
-        self.conv1  = GCNConv(h[0], h[1])
-        self.conv2  = GCNConv(h[1], h[2])
-        self.conv3  = GCNConv(h[2], h[3])
-        self.conv4  = GCNConv(h[3], h[4])
-        self.conv5  = GCNConv(h[4], h[5])
-        self.conv6  = GCNConv(h[5], h[6])
-        self.conv7  = GCNConv(h[6], h[7])
-        self.conv8  = GCNConv(h[7], h[8])
-        self.conv9  = GCNConv(h[8], h[9])
-        self.conv10 = GCNConv(h[9], h[10])
-        self.conv11 = GCNConv(h[10], h[11])
-        self.conv12 = GCNConv(h[11], h[12])
+        self.conv1  = GCNConv(h[0], h[1], normalize=False)
+        self.conv2  = GCNConv(h[1], h[2], normalize=False)
+        self.conv3  = GCNConv(h[2], h[3], normalize=False)
+        self.conv4  = GCNConv(h[3], h[4], normalize=False)
+        self.conv5  = GCNConv(h[4], h[5], normalize=False)
+        self.conv6  = GCNConv(h[5], h[6], normalize=False)
+        self.conv7  = GCNConv(h[6], h[7], normalize=False)
+        self.conv8  = GCNConv(h[7], h[8], normalize=False)
+        self.conv9  = GCNConv(h[8], h[9], normalize=False)
+        self.conv10 = GCNConv(h[9], h[10], normalize=False)
+        self.conv11 = GCNConv(h[10], h[11], normalize=False)
+        self.conv12 = GCNConv(h[11], h[12], normalize=False)
 
         self.linear1 = nn.Linear(h[12], h[13])
         self.linear2 = nn.Linear(h[13], h[14])
@@ -103,24 +185,17 @@ class NormalNet(nn.Module):
         self.bn12 = nn.BatchNorm1d(h[12])
 
         self.l_relu = nn.LeakyReLU()
-            
+        self._adj = {}
+
+    def blocks(self) -> list:
+        return [(getattr(self, "conv%d" % i), getattr(self, "bn%d" % i)) for i in range(1, 13)]
 
     def forward(self, data):
 
-        z2, x_pos, edge_index = data.z2.to(self.device), data.x_pos.to(self.device), data.face_index.to(self.device)
+        z2, x_pos = data.z2.to(self.device), data.x_pos.to(self.device)
+        edge_index, edge_weight = cached_adjacency(self._adj, data.face_index, z2.shape[0], self.device)
         #n2 = torch.randn(z2.shape[0], z2.shape[1]).to(self.device) * 0.01
-        dx = self.l_relu(self.bn1(self.conv1(z2, edge_index)))
-        dx = self.l_relu(self.bn2(self.conv2(dx, edge_index)))
-        dx = self.l_relu(self.bn3(self.conv3(dx, edge_index)))
-        dx = self.l_relu(self.bn4(self.conv4(dx, edge_index)))
-        dx = self.l_relu(self.bn5(self.conv5(dx, edge_index)))
-        dx = self.l_relu(self.bn6(self.conv6(dx, edge_index)))
-        dx = self.l_relu(self.bn7(self.conv7(dx, edge_index)))
-        dx = self.l_relu(self.bn8(self.conv8(dx, edge_index)))
-        dx = self.l_relu(self.bn9(self.conv9(dx, edge_index)))
-        dx = self.l_relu(self.bn10(self.conv10(dx, edge_index)))
-        dx = self.l_relu(self.bn11(self.conv11(dx, edge_index)))
-        dx = self.l_relu(self.bn12(self.conv12(dx, edge_index)))
+        dx = run_blocks(self.blocks(), z2, edge_index, edge_weight, self.l_relu, self.checkpoint_segments if self.training else 0)
         
         dx = self.l_relu(self.linear1(dx))
         dx = torch.tanh(self.linear2(dx))
@@ -0,0 +1,106 @@
+import numpy as np
+import torch
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from torch_geometric.data import Data
+import util.distributed as Dist
+from util.datamaker import Dataset, MeshInputs
+from util.mesh import Mesh
+from util.topology import Topology
+
+def farthest_points(vs: np.ndarray, k: int, seed=314) -> np.ndarray:
+    """ greedy farthest point sampling of k vertex ids """
+    rng = np.random.RandomState(seed)
+    ids = [rng.randint(len(vs))]
+    dist = np.linalg.norm(vs - vs[ids[0]], axis=1)
+    for _ in range(1, k):
+        ids.append(int(np.argmax(dist)))
+        dist = np.minimum(dist, np.linalg.norm(vs - vs[ids[-1]], axis=1))
+    return np.array(ids)
+
+def partition_vertices(mesh: Mesh, n_parts: int, seed=314) -> np.ndarray:
+    """ split vertices into geodesic voronoi cells around farthest-point seeds """
+    vs, edges = mesh.vs, mesh.edges
+    seeds = farthest_points(vs, n_parts, seed=seed)
+    e_len = np.linalg.norm(vs[edges[:, 0]] - vs[edges[:, 1]], axis=1) + 1.0e-12
+    graph = csr_matrix((e_len, (edges[:, 0], edges[:, 1])), shape=(len(vs), len(vs)))
+    _, _, sources = dijkstra(graph, directed=False, indices=seeds, min_only=True, return_predecessors=True)
+
+    # vertices on components without a seed join the nearest seed in space
+    unreached = np.nonzero(sources < 0)[0]
+    if len(unreached) > 0:
+        d = np.linalg.norm(vs[unreached].reshape(-1, 1, 3) - vs[seeds].reshape(1, -1, 3), axis=2)
+        sources[unreached] = seeds[np.argmin(d, axis=1)]
+    labels = -np.ones(len(vs), dtype=np.int64)
+    labels[seeds] = np.arange(n_parts)
+    return labels[sources]
+
+def shared_labels(mesh: Mesh, n_parts: int, nv: int, seed=314) -> np.ndarray:
+    """ partition_vertices of the full mesh, computed on rank 0 (the only rank holding it, the others pass None) and sent to every rank """
+    if Dist.is_main():
+        labels = torch.from_numpy(partition_vertices(mesh, n_parts, seed=seed))
+    else:
+        labels = torch.empty(nv, dtype=torch.long)
+    return Dist.broadcast(labels).numpy()
+
+class Patch:
+    """ sub-mesh made of one partition cell (the core) and `halo` rings of neighbouring vertices """
+    def __init__(self, inputs: MeshInputs, verts: np.ndarray, faces: np.ndarray, core_verts: np.ndarray, core_faces: np.ndarray, device):
+        self.verts = verts
+        self.faces = faces
+        self.core_verts = core_verts
+        self.core_faces = core_faces
+
+        local = -np.ones(len(inputs.vs), dtype=np.int64)
+        local[verts] = np.arange(len(verts))
+        self.topology = Topology(local[inputs.faces[faces]], len(verts))
+
+        sub = inputs.subset(verts, faces)
+        edge_index = torch.tensor(self.topology.edges.T, dtype=torch.long)
+        edge_index = torch.cat([edge_index, edge_index[[1, 0], :]], dim=1)
+        face_index = torch.from_numpy(self.topology.f_edges)
+        data = Data(x=sub["z1"], z1=sub["z1"], z2=sub["z2"], x_pos=sub["x_pos"], x_norm=sub["x_norm"], edge_index=edge_index, face_index=face_index)
+        self.dataset = Dataset(data)
+
+        self.n_vs = torch.from_numpy(sub["n_vs"]).to(device)
+        self.n_fn = torch.from_numpy(sub["n_fn"]).to(device)
+        self.mesh_t = self.topology.tensors(device)
+
+class Partition:
+    """ overlapping patches covering a mesh, for training on meshes too large for one graph """
+    def __init__(self, inputs: MeshInputs, labels: np.ndarray, n_parts: int, halo=4, device="cpu", parts=None):
+        assert halo >= 1, "patches need at least one halo ring to contain the faces of their core vertices"
+        self.nv = len(inputs.vs)
+        self.nf = len(inputs.faces)
+        self.labels = labels
+        mesh_faces = inputs.faces
+        face_owner = self.labels[mesh_faces[:, 0]]
+
+        # only the patches in `parts` are built, the others are left as None
+        self.patches = [None] * n_parts
+        for part in range(n_parts) if parts is None else parts:
+            mask = self.labels == part
+            # every mesh edge lies on a face, so one ring adds the vertices of the faces touching the patch
+            for _ in range(halo):
+                mask[mesh_faces[mask[mesh_faces].any(axis=1)]] = True
+            verts = np.nonzero(mask)[0]
+            faces = np.nonzero(mask[mesh_faces].all(axis=1))[0]
+            core_verts = self.labels[verts] == part
+            core_faces = face_owner[faces] == part
+            self.patches[part] = Patch(inputs, verts, faces, core_verts, core_faces, device)
+
+    def stitch_vertices(self, values: list, parts=None) -> torch.Tensor:
+        """ full-mesh vertex values from per-patch outputs, taking each vertex from its core patch; rows of patches not in `parts` stay zero """
+        out = values[0].new_zeros((self.nv,) + tuple(values[0].shape[1:]))
+        patches = self.patches if parts is None else [self.patches[p] for p in parts]
+        for patch, v in zip(patches, values):
+            out[torch.from_numpy(patch.verts[patch.core_verts]).to(v.device)] = v[torch.from_numpy(patch.core_verts).to(v.device)]
+        return out
+
+    def stitch_faces(self, values: list, parts=None) -> torch.Tensor:
+        """ full-mesh face values from per-patch outputs, taking each face from its core patch; rows of patches not in `parts` stay zero """
+        out = values[0].new_zeros((self.nf,) + tuple(values[0].shape[1:]))
+        patches = self.patches if parts is None else [self.patches[p] for p in parts]
+        for patch, v in zip(patches, values):
+            out[torch.from_numpy(patch.faces[patch.core_faces]).to(v.device)] = v[torch.from_numpy(patch.core_faces).to(v.device)]
+        return out
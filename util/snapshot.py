@@ -0,0 +1,103 @@
+import os
+import queue
+import threading
+import numpy as np
+import torch
+import util.loss as Loss
+import util.models as Models
+from util.mesh import Mesh
+from util.instrument import stage
+
+FORMATS = ["obj", "ply", "npz"]
+
+class SnapshotWriter:
+    """ evaluates and writes mesh snapshots on a background thread, fed through a bounded queue """
+    def __init__(self, mesh: Mesh, out_dir: str, gt_mesh: Mesh=None, formats=("obj",), keep_best=False, vs_update=False, max_queue=2, tag="ddmp"):
+        assert all(f in FORMATS for f in formats), "unknown snapshot format"
+        self.mesh = mesh
+        self.out_dir = out_dir
+        self.gt_mesh = gt_mesh
+        self.formats = list(formats)
+        self.keep_best = keep_best
+        self.vs_update = vs_update
+        self.tag = tag
+        self.mad = None
+        self.best_mad = None
+        self.best_paths = []
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                with stage("snapshot_write"):
+                    self.write(*item)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, epoch: int, pos: torch.Tensor, norm: torch.Tensor=None):
+        """ queue a snapshot of detached cpu copies; blocks while the queue is full """
+        self._raise()
+        pos = pos.detach().to("cpu", copy=True)
+        norm = norm.detach().to("cpu", copy=True) if norm is not None and self.vs_update else None
+        self._queue.put((epoch, pos, norm))
+
+    def close(self):
+        """ wait for queued snapshots and stop the thread """
+        self._queue.put(None)
+        self._thread.join()
+        self._raise()
+
+    def save(self, mesh: Mesh, name: str) -> list:
+        paths = []
+        for fmt in self.formats:
+            path = os.path.join(self.out_dir, name + "." + fmt)
+            if fmt == "obj":
+                Mesh.save(mesh, path)
+            elif fmt == "ply":
+                Mesh.save_as_ply(mesh, path, mesh.fn)
+            else:
+                np.savez(path, vs=mesh.vs, faces=mesh.faces)
+            paths.append(path)
+        return paths
+
+    def write(self, epoch: int, pos: torch.Tensor, norm: torch.Tensor=None):
+        """ evaluate one snapshot and write it (and its vertex-updated version) in every format """
+        mesh = self.mesh.with_vertices(pos.numpy())
+        name = str(epoch) + "_" + self.tag
+        mad = None
+        if self.gt_mesh is not None:
+            mad = self.mad = Loss.mad(mesh.fn, self.gt_mesh.fn)
+            name += "={:.3f}".format(mad)
+
+        # with keep_best only the best snapshot so far (the latest one without ground truth) stays on disk
+        if self.keep_best and mad is not None and self.best_mad is not None and mad >= self.best_mad:
+            return
+        if self.keep_best:
+            for path in self.best_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+        self.best_mad = mad
+        paths = self.save(mesh, name)
+
+        if norm is not None:
+            with torch.no_grad():
+                updated_pos = Models.vertex_updating(pos, norm, mesh, loop=15)
+            u_mesh = self.mesh.with_vertices(updated_pos.numpy())
+            u_name = str(epoch) + "_" + self.tag + "_updated"
+            if self.gt_mesh is not None:
+                u_name += "={:.3f}".format(Loss.mad(u_mesh.fn, self.gt_mesh.fn))
+            paths += self.save(u_mesh, u_name)
+        self.best_paths = paths
@@ -0,0 +1,206 @@
+import numpy as np
+import torch
+from scipy.sparse import csr_matrix, identity
+
+
+def split_rows(values: np.ndarray, counts: np.ndarray) -> list:
+    """ split a flat array into per-row python lists """
+    flat = values.tolist()
+    ends = np.cumsum(counts).tolist()
+    return [flat[e - c:e] for e, c in zip(ends, counts.tolist())]
+
+def _occurrence(keys: np.ndarray) -> np.ndarray:
+    """ running count of each key among the entries preceding it """
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    start = np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]
+    first = np.maximum.accumulate(np.where(start, np.arange(len(keys)), 0))
+    occ = np.empty(len(keys), dtype=np.int64)
+    occ[order] = np.arange(len(keys)) - first
+    return occ
+
+def build_edges(faces: np.ndarray, nv: int) -> dict:
+    """ compute edges, vertex-to-edge lists and mesh-cnn style gemm neighbours of a triangle mesh """
+    nf = len(faces)
+    he = np.stack([faces, np.roll(faces, -1, axis=1)], axis=2).reshape(-1, 2)
+    he = np.sort(he, axis=1).astype(np.int64)
+    keys = he[:, 0] * nv + he[:, 1]
+
+    # edge ids follow the order in which edges first appear in the face list
+    uniq, first, inv = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty(len(uniq), dtype=np.int64)
+    rank[order] = np.arange(len(uniq))
+    he_edge = rank[inv.reshape(-1)]
+    edges = he[first[order]]
+    edges_count = len(edges)
+
+    he_occ = _occurrence(he_edge)
+    assert he_occ.max(initial=0) < 2, "non-manifold edge detected"
+
+    he_next = (np.arange(3 * nf).reshape(-1, 3)[:, [1, 2, 0]]).reshape(-1)
+    he_prev = (np.arange(3 * nf).reshape(-1, 3)[:, [2, 0, 1]]).reshape(-1)
+    gemm_edges = -np.ones((edges_count, 4), dtype=np.int64)
+    sides = -np.ones((edges_count, 4), dtype=np.int64)
+    gemm_edges[he_edge, 2 * he_occ] = he_edge[he_next]
+    gemm_edges[he_edge, 2 * he_occ + 1] = he_edge[he_prev]
+    sides[he_edge, 2 * he_occ] = 2 * he_occ[he_next] + 1
+    sides[he_edge, 2 * he_occ + 1] = 2 * he_occ[he_prev]
+
+    """ vertex-to-edge lists """
+    ve_verts = edges.reshape(-1)
+    ve_edges = np.repeat(np.arange(edges_count), 2)
+    ve_sides = np.tile([0, 1], edges_count)
+    ve_order = np.lexsort((ve_edges, ve_verts))
+    ve_counts = np.bincount(ve_verts, minlength=nv)
+    ve = split_rows(ve_edges[ve_order], ve_counts)
+    vei = split_rows(ve_sides[ve_order], ve_counts)
+
+    return {
+        "edges": edges.astype(np.int32),
+        "gemm_edges": gemm_edges,
+        "sides": sides,
+        "edges_count": edges_count,
+        "ve": ve,
+        "vei": vei,
+        "he_edge": he_edge,
+    }
+
+def build_vert_faces(faces: np.ndarray, nv: int) -> dict:
+    """ compute vertex-to-face incidence (sorted by vertex, then face) """
+    nf = len(faces)
+    keys = np.unique(faces.reshape(-1).astype(np.int64) * nf + np.repeat(np.arange(nf), 3))
+    vf_verts = keys // nf
+    vf_faces = keys % nf
+    vf_counts = np.bincount(vf_verts, minlength=nv)
+    return {"vf_verts": vf_verts, "vf_faces": vf_faces, "vf_counts": vf_counts}
+
+def build_face_faces(faces: np.ndarray, he_edge: np.ndarray) -> np.ndarray:
+    """ compute edge-adjacent faces, padded with -1 at the end of each row """
+    nf = len(faces)
+    he_face = np.repeat(np.arange(nf), 3)
+    order = np.argsort(he_edge, kind="stable")
+    sorted_edge = he_edge[order]
+    shared = np.nonzero(sorted_edge[1:] == sorted_edge[:-1])[0]
+    h0, h1 = order[shared], order[shared + 1]
+
+    f2f = -np.ones(3 * nf, dtype=np.int64)
+    f2f[h0] = he_face[h1]
+    f2f[h1] = he_face[h0]
+    f2f = f2f.reshape(-1, 3)
+    # move the -1 paddings to the end of each row, keeping the neighbour order
+    pad_order = np.argsort(f2f == -1, axis=1, kind="stable")
+    return np.take_along_axis(f2f, pad_order, axis=1)
+
+class Topology:
+    """ connectivity of a triangle mesh; built once and shared by meshes with identical faces """
+    def __init__(self, faces: np.ndarray, nv: int):
+        self.faces = faces
+        self.nv = nv
+        self._tensors = {}
+        self._face_neighbours = {}
+        self.build_gemm()
+        self.build_vf()
+        self.build_v2v()
+
+    def matches(self, faces: np.ndarray, nv: int) -> bool:
+        return self.nv == nv and np.array_equal(self.faces, faces)
+
+    def tensors(self, device) -> "TopologyTensors":
+        """ torch copies of the connectivity on the given device, built on first use """
+        key = str(torch.device(device))
+        if key not in self._tensors:
+            self._tensors[key] = TopologyTensors(self, device)
+        return self._tensors[key]
+
+    def build_gemm(self):
+        topo = build_edges(self.faces, self.nv)
+        self.ve = topo["ve"]
+        self.vei = topo["vei"]
+        self.edges = topo["edges"]
+        self.gemm_edges = topo["gemm_edges"]
+        self.sides = topo["sides"]
+        self.edges_count = topo["edges_count"]
+        self.he_edge = topo["he_edge"]
+
+    def build_vf(self):
+        topo = build_vert_faces(self.faces, self.nv)
+        self.vf_verts, self.vf_faces, self.vf_counts = topo["vf_verts"], topo["vf_faces"], topo["vf_counts"]
+        self.vf_indptr = np.concatenate([[0], np.cumsum(self.vf_counts)])
+        self.vf = [set(f) for f in split_rows(self.vf_faces, self.vf_counts)]
+
+        """ build vertex-to-face sparse matrix """
+        v2f_inds = torch.from_numpy(np.stack([self.vf_verts, self.vf_faces])).long()
+        v2f_vals = torch.ones(v2f_inds.shape[1]).float()
+        self.v2f_mat = torch.sparse.FloatTensor(v2f_inds, v2f_vals, size=torch.Size([self.nv, len(self.faces)]))
+
+        """ build face-to-vertex summation matrix (one entry per face corner) """
+        f2v_cols = np.repeat(np.arange(len(self.faces)), 3)
+        f2v_vals = np.ones(len(f2v_cols))
+        self.f2v_mat = csr_matrix((f2v_vals, (self.faces.reshape(-1), f2v_cols)), shape=(self.nv, len(self.faces)))
+
+        """ build face-to-face (1ring) matrix """
+        self.f2f = build_face_faces(self.faces, self.he_edge)
+        f_rows = np.repeat(np.arange(len(self.faces)), 3)
+        has_neig = self.f2f.reshape(-1) != -1
+        self.f_edges = np.stack([f_rows[has_neig], self.f2f.reshape(-1)[has_neig]])
+
+    def face_neighbours(self, neig="edge", ring=1) -> csr_matrix:
+        """ face adjacency without self loops, over edge- or vertex-sharing faces within `ring` rings """
+        assert neig in ("edge", "vertex") and ring >= 1
+        key = (neig, ring)
+        if key not in self._face_neighbours:
+            nf = len(self.faces)
+            if neig == "edge":
+                step = csr_matrix((np.ones(self.f_edges.shape[1]), (self.f_edges[0], self.f_edges[1])), shape=(nf, nf))
+            else:
+                f2v = self.f2v_mat.T.tocsr()
+                step = f2v.dot(f2v.T)
+            step = (step + identity(nf, format="csr")).tocsr()
+            step.data[:] = 1.0
+            reach = step
+            for _ in range(ring - 1):
+                reach = reach.dot(step)
+                reach.data[:] = 1.0
+            reach.setdiag(0)
+            reach.eliminate_zeros()
+            reach.sort_indices()
+            self._face_neighbours[key] = reach
+        return self._face_neighbours[key]
+
+    def build_v2v(self):
+        """ compute adjacent matrix and vertex degrees """
+        v2v_inds = self.edges.T
+        v2v_inds = torch.from_numpy(np.concatenate([v2v_inds, v2v_inds[[1, 0]]], axis=1)).long()
+        v2v_vals = torch.ones(v2v_inds.shape[1]).float()
+        self.v2v_mat = torch.sparse.FloatTensor(v2v_inds, v2v_vals, size=torch.Size([self.nv, self.nv]))
+        # isolated vertices get degree 1 so that their laplacian stays finite
+        v_dims = np.bincount(self.edges.reshape(-1), minlength=self.nv)
+        self.v_dims = torch.from_numpy(np.maximum(v_dims, 1)).float()
+
+class TopologyTensors:
+    """ connectivity used by the losses, uploaded once to a device """
+    def __init__(self, topology: Topology, device):
+        self.topology = topology
+        self.device = torch.device(device)
+        self.nv = topology.nv
+        self.faces = torch.from_numpy(topology.faces).long().to(device)
+        self.v2v_mat = topology.v2v_mat.coalesce().to(device)
+        self.v_dims = topology.v_dims.reshape(-1, 1).to(device)
+        self._face_pairs = {}
+
+    def face_pairs(self, neig="edge", ring=1):
+        """ (face, neighbour) index pairs of Topology.face_neighbours on this device """
+        key = (neig, ring)
+        if key not in self._face_pairs:
+            adj = self.topology.face_neighbours(neig, ring)
+            rows = np.repeat(np.arange(adj.shape[0]), np.diff(adj.indptr))
+            rows = torch.from_numpy(rows).long().to(self.device)
+            cols = torch.from_numpy(adj.indices).long().to(self.device)
+            self._face_pairs[key] = (rows, cols)
+        return self._face_pairs[key]
+
+    def tensors(self, device) -> "TopologyTensors":
+        if torch.device(device) == self.device:
+            return self
+        return self.topology.tensors(device)
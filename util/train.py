@@ -0,0 +1,43 @@
+import torch
+import torch.nn as nn
+import util.instrument as Instrument
+import util.loss as Loss
+import util.models as Models
+from util.networks import autocast, frozen_batchnorm
+
+def predict(args, posnet, normnet, dataset, device):
+    """ run both networks on one graph and return fp32 positions and normals """
+    with autocast(args.precision, device):
+        pos = posnet(dataset)
+        norm = normnet(dataset)
+    return pos.float(), norm.float()
+
+def snapshot_predict(args, posnet, normnet, dataset, device):
+    """ predict like a training step, without touching the batchnorm running statistics or the rng of training """
+    bns = [m for net in (posnet, normnet) for m in net.modules() if isinstance(m, nn.BatchNorm1d)]
+    with torch.no_grad(), torch.random.fork_rng(devices=[]), frozen_batchnorm(bns):
+        return predict(args, posnet, normnet, dataset, device)
+
+def compute_loss(args, epoch, posnet, normnet, dataset, mesh_t, n_vs, n_fn, device):
+    """ weighted training loss on the full mesh or on one patch """
+    with Instrument.stage("forward"):
+        pos, norm = predict(args, posnet, normnet, dataset, device)
+    geo = Models.FaceGeometry(pos, mesh_t.faces)
+    with Instrument.stage("pos_rec_loss"):
+        loss_pos1 = Loss.pos_rec_loss(pos, n_vs)
+    with Instrument.stage("mesh_laplacian_loss"):
+        loss_pos2 = Loss.mesh_laplacian_loss(pos, mesh_t)
+
+    with Instrument.stage("norm_rec_loss"):
+        loss_norm1 = Loss.norm_rec_loss(norm, n_fn)
+    with Instrument.stage("fn_bnf_loss"):
+        loss_norm2, _ = Loss.fn_bnf_loss(pos, norm, mesh_t, loop=args.bnfloop, geo=geo, neig=args.bnf_neig, ring=args.bnf_ring)
+    
+    if epoch <= 100:
+        loss_norm2 = loss_norm2 * 0.0
+
+    with Instrument.stage("pos_norm_loss"):
+        loss_pos3 = Loss.pos_norm_loss(pos, norm, mesh_t, geo=geo)
+
+    loss = args.k1 * loss_pos1 + args.k2 * loss_pos2 + args.k3 * loss_norm1 + args.k4 * loss_norm2 + args.k5 * loss_pos3
+    return loss, pos, norm